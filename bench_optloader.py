@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import platform
+import random
+import struct
+import sys
+import time
+
+from mrcrowbar import utils
+from mrcrowbar.lib.os import win16
+
+import optloader
+from optloader import optloader_decompress, optloader_get_relocs, optloader_map_file, optloader_segment_raw
+
+
+# back-reference limits of the OPTLOADER bit stream
+OPTLOADER_MAX_MATCH = 0x80
+OPTLOADER_SHORT_DISTANCE = 0x100
+OPTLOADER_MAX_DISTANCE = 0x8000
+# escape byte for the end of the stream; anything past 0x81 works
+OPTLOADER_END_MARKER = 0xff
+
+# number of earlier positions to try for each match
+COMPRESS_CHAIN_DEPTH = 16
+# write the length of every nth back-reference as a raw byte
+COMPRESS_ESCAPE_EVERY = 7
+
+
+# encoder for the OPTLOADER bit stream, the inverse of OptloaderDecoder. a control
+# word's slot is reserved as soon as the previous one is full, and the bytes for
+# the codes that follow go after it
+class OptloaderEncoder:
+    def __init__( self ):
+        self.out = bytearray( 2 )
+        self.slot = 0
+        self.word = 0
+        self.bits = 0
+
+    def put_bits( self, value, size ):
+        for i in range( size-1, -1, -1 ):
+            self.word = (self.word << 1) | ((value >> i) & 1)
+            self.bits += 1
+            if self.bits == 16:
+                self.out[self.slot:self.slot+2] = struct.pack( '<H', self.word )
+                self.slot = len( self.out )
+                self.out += b'\x00\x00'
+                self.word = 0
+                self.bits = 0
+
+    def literal( self, value ):
+        self.put_bits( 0b1, 1 )
+        self.out.append( value )
+
+    # back-reference of length bytes, distance bytes back; escape writes the length
+    # as a raw byte even if it has a shorter code
+    def match( self, length, distance, escape=False ):
+        # the distance is stored less one, as a high byte code and a raw low byte
+        distance -= 1
+        if escape or length >= 20:
+            # a raw length byte works for any length, and is always
+            # followed by the full offset code
+            self.put_bits( 0b011111, 6 )
+            self.out.append( length )
+        elif length == 2:
+            self.put_bits( 0b000, 3 )
+            self.out.append( distance )
+            return
+        elif length == 3:
+            self.put_bits( 0b001, 3 )
+        elif length < 6:
+            self.put_bits( 0b0100 | (length-4), 4 )
+        elif length < 8:
+            self.put_bits( 0b01100 | (length-6), 5 )
+        elif length < 12:
+            self.put_bits( 0b0111000 | (length-8), 7 )
+        else:
+            self.put_bits( 0b011110000 | (length-12), 9 )
+
+        high = distance >> 8
+        if high == 0:
+            self.put_bits( 0b00, 2 )
+        elif high == 1:
+            self.put_bits( 0b010, 3 )
+        elif high < 4:
+            self.put_bits( 0b0110 | (high-2), 4 )
+        elif high < 8:
+            self.put_bits( 0b10000 | (high-4), 5 )
+        elif high < 16:
+            self.put_bits( 0b101000 | (high-8), 6 )
+        elif high < 32:
+            self.put_bits( 0b1100000 | (high-16), 7 )
+        elif high < 48:
+            self.put_bits( 0b11100000 | (high-32), 8 )
+        elif high < 64:
+            self.put_bits( 0b111100000 | (high-48), 9 )
+        else:
+            self.put_bits( 0b11111000000 | (high-64), 11 )
+        self.out.append( distance & 0xff )
+
+    # end-of-stream marker, returns the compressed stream
+    def finish( self ):
+        self.put_bits( 0b011111, 6 )
+        self.out.append( OPTLOADER_END_MARKER )
+        if self.bits:
+            self.out[self.slot:self.slot+2] = struct.pack( '<H', self.word << (16-self.bits) )
+        return bytes( self.out )
+
+
+# greedy LZ77 compressor; nowhere near as tight as OPTLINK, but it uses every
+# code, including overlapping back-references. every escape_every-th
+# back-reference has its length escaped, so short escaped lengths turn up too
+def optloader_compress( data, escape_every=COMPRESS_ESCAPE_EVERY ):
+    encoder = OptloaderEncoder()
+    matches = 0
+    chains = {}
+    last_pair = {}
+    size = len( data )
+    i = 0
+    while i < size:
+        best_length = 0
+        best_distance = 0
+        for j in reversed( chains.get( data[i:i+3], [] )[-COMPRESS_CHAIN_DEPTH:] ):
+            if i-j > OPTLOADER_MAX_DISTANCE:
+                break
+            length = 3
+            limit = min( OPTLOADER_MAX_MATCH, size-i )
+            while length < limit and data[j+length] == data[i+length]:
+                length += 1
+            if length > best_length:
+                best_length, best_distance = length, i-j
+                if length == limit:
+                    break
+        if best_length < 3:
+            # 2 byte matches only get a single byte of distance
+            j = last_pair.get( data[i:i+2] )
+            if j is not None and i+2 <= size and i-j <= OPTLOADER_SHORT_DISTANCE:
+                best_length, best_distance = 2, i-j
+
+        step = best_length if best_length else 1
+        for k in range( i, min( i+step, size-2 ) ):
+            chains.setdefault( data[k:k+3], [] ).append( k )
+        for k in range( i, min( i+step, size-1 ) ):
+            last_pair[data[k:k+2]] = k
+
+        if best_length:
+            matches += 1
+            encoder.match( best_length, best_distance, escape=bool( escape_every ) and matches % escape_every == 0 )
+        else:
+            encoder.literal( data[i] )
+        i += step
+    return encoder.finish()
+
+
+# OPTLOADER relocation source types
+RELOC_INTERNAL = 0
+RELOC_ORDINAL = 1
+RELOC_NAME = 2
+RELOC_OSFIXUP = 3
+
+
+# random OPTLOADER relocation list for a segment, as (list, count)
+def optloader_make_relocs( rng, seg_count, seg_size ):
+    result = bytearray()
+    count = 0
+    offset_limit = max( 1, seg_size-4 )
+    for i in range( rng.randrange( 0, 8 ) ):
+        src_type = rng.choice( (RELOC_INTERNAL, RELOC_ORDINAL, RELOC_NAME, RELOC_OSFIXUP, None) )
+        num_items = rng.randrange( 1, 32 )
+        if src_type is None:
+            # special base type, a list of segment selectors
+            result += bytes( (0xf0, num_items) )
+            for j in range( num_items ):
+                result += struct.pack( '<BH', rng.randrange( 1, seg_count+1 ), rng.randrange( offset_limit ) )
+            count += num_items
+            continue
+
+        result += bytes( (rng.randrange( 8 ) | (src_type << 3), num_items) )
+        if src_type == RELOC_INTERNAL:
+            # a fixed segment has a single target offset, movable
+            # segments (0xff) have one per item
+            segment = rng.choice( (0xff, rng.randrange( 1, seg_count+1 )) )
+            result.append( segment )
+            if segment != 0xff:
+                num_items = 1
+                result[-2] = num_items
+            for j in range( num_items ):
+                result += struct.pack( '<HH', rng.randrange( offset_limit ), rng.randrange( 0x10000 ) )
+        elif src_type in (RELOC_ORDINAL, RELOC_NAME):
+            result += struct.pack( '<H', rng.randrange( 1, 16 ) )
+            for j in range( num_items ):
+                result += struct.pack( '<HH', rng.randrange( offset_limit ), rng.randrange( 1, 0x400 ) )
+        else:
+            result += struct.pack( '<H', rng.randrange( 1, 7 ) )
+            for j in range( num_items ):
+                result += struct.pack( '<H', rng.randrange( offset_limit ) )
+        count += num_items
+    return bytes( result ), count
+
+
+# size bytes that compress roughly like real segments: recurring instruction
+# snippets, random immediates and zero padding
+def optloader_make_code( rng, size, snippets ):
+    result = bytearray()
+    while len( result ) < size:
+        kind = rng.random()
+        if kind < 0.7:
+            result += rng.choice( snippets )
+        elif kind < 0.95:
+            result += rng.randbytes( rng.randrange( 1, 5 ) )
+        else:
+            result += bytes( rng.randrange( 4, 0x100 ) )
+    return bytes( result[:size] )
+
+
+# generate count synthetic segments, each with the window optloader_unpack_segment
+# gets (random sector padding included), alloc size, original data and reloc count
+def make_segments( seed, count, min_size, max_size, seg_count=None ):
+    rng = random.Random( seed )
+    snippets = [rng.randbytes( rng.randrange( 1, 9 ) ) for i in range( 256 )]
+    seg_count = seg_count or count+1
+    result = []
+    for i in range( count ):
+        data = optloader_make_code( rng, rng.randrange( min_size, max_size+1 ), snippets )
+        relocs, relocs_count = optloader_make_relocs( rng, seg_count, len( data ) )
+        segment = struct.pack( '<H', relocs_count ) + optloader_compress( data ) + relocs
+        predelta = rng.randrange( 0x200 )
+        postdelta = 0x200-((len( segment )+predelta) % 0x200)
+        raw = rng.randbytes( predelta ) + segment + rng.randbytes( postdelta )
+        result.append( {
+            'raw': raw,
+            'start_offset': predelta,
+            'alloc_size': len( data )+rng.randrange( 0x20 ),
+            'data': data,
+            'relocs_count': relocs_count,
+            'compressed_size': len( segment ),
+        } )
+    return result
+
+
+# one segment for every escaped length below 20, as a back-reference over 8
+# literals followed by 2 more; the compressor never makes lengths 0 and 1
+def make_escape_segments():
+    literals = b'ABCDEFGH'
+    result = []
+    for length in range( 20 ):
+        encoder = OptloaderEncoder()
+        for x in literals:
+            encoder.literal( x )
+        encoder.match( length, len( literals ), escape=True )
+        for x in b'XY':
+            encoder.literal( x )
+        segment = struct.pack( '<H', 0 ) + encoder.finish()
+        data = literals + (literals*3)[:length] + b'XY'
+        result.append( {
+            'raw': segment,
+            'start_offset': 0,
+            'alloc_size': len( data ),
+            'data': data,
+            'relocs_count': 0,
+            'compressed_size': len( segment ),
+        } )
+    return result
+
+
+# segments 2 onwards from a real executable; there's no original data for these,
+# so only the relocation counts and --reference hashes are checked
+def load_segments( path ):
+    with optloader_map_file( path ) as in_file:
+        e = win16.EXE( in_file )
+        result = []
+        for seg in e.ne_header.segtable[1:]:
+            raw, start_offset = optloader_segment_raw( in_file, seg.offset, seg.size )
+            raw = bytes( raw )
+            result.append( {
+                'raw': raw,
+                'start_offset': start_offset,
+                'alloc_size': seg.alloc_size,
+                'data': None,
+                'relocs_count': utils.from_uint16_le( raw[start_offset:start_offset+2] ),
+                'compressed_size': seg.size,
+            } )
+    return result
+
+
+def latency_stats( times ):
+    times = sorted( times )
+    return {
+        'mean_us': round( 1e6*sum( times )/len( times ), 2 ),
+        'median_us': round( 1e6*times[len( times )//2], 2 ),
+        'p95_us': round( 1e6*times[min( len( times )-1, int( len( times )*0.95 ) )], 2 ),
+        'max_us': round( 1e6*times[-1], 2 ),
+    }
+
+
+# time decompression and relocation parsing for each segment, keeping the best
+# of repeat runs. with verify, the pure Python decoder output is compared too
+def bench_segments( segments, repeat=5, native=True, verify=False ):
+    per_segment = []
+    decompress_times = []
+    relocs_times = []
+    for index, seg in enumerate( segments ):
+        raw, start_offset, alloc_size = seg['raw'], seg['start_offset'], seg['alloc_size']
+        best_decompress = best_relocs = float( 'inf' )
+        for i in range( repeat ):
+            start = time.perf_counter()
+            data, relocs_offset = optloader_decompress( raw, start_offset+2, alloc_size, native=native )
+            mid = time.perf_counter()
+            relocs = optloader_get_relocs( raw, relocs_offset, seg['relocs_count'] )
+            end = time.perf_counter()
+            best_decompress = min( best_decompress, mid-start )
+            best_relocs = min( best_relocs, end-mid )
+        decompress_times.append( best_decompress )
+        relocs_times.append( best_relocs )
+
+        result = {
+            'index': index,
+            'size': alloc_size,
+            'compressed_size': seg['compressed_size'],
+            'relocations': len( relocs ),
+            'data_sha256': hashlib.sha256( data ).hexdigest(),
+            'relocs_sha256': hashlib.sha256( relocs.export_data() ).hexdigest(),
+            'errors': [],
+        }
+        if verify and (data, relocs_offset) != optloader_decompress( raw, start_offset+2, alloc_size, native=False ):
+            result['errors'].append( 'data does not match the Python decoder' )
+        if seg['data'] is not None:
+            expected = seg['data'] + bytes( alloc_size-len( seg['data'] ) )
+            if data != expected:
+                result['errors'].append( 'data does not match the original' )
+        per_segment.append( result )
+
+    total_size = sum( x['size'] for x in per_segment )
+    total_relocs = sum( x['relocations'] for x in per_segment )
+    results = {
+        'segments': len( per_segment ),
+        'bytes': total_size,
+        'compressed_bytes': sum( x['compressed_size'] for x in per_segment ),
+        'relocations': total_relocs,
+        'decompress': {
+            'seconds': round( sum( decompress_times ), 6 ),
+            'mb_per_s': round( total_size/sum( decompress_times )/1e6, 3 ),
+            'latency': latency_stats( decompress_times ),
+        },
+        'relocs': {
+            'seconds': round( sum( relocs_times ), 6 ),
+            'relocs_per_s': round( total_relocs/sum( relocs_times ), 1 ),
+            'latency': latency_stats( relocs_times ),
+        },
+    }
+    return results, per_segment
+
+
+# compare segment hashes with an earlier run, returns the number that differ
+def check_reference( per_segment, reference ):
+    if len( reference ) != len( per_segment ):
+        raise ValueError( 'Reference has {} segments, expected {}'.format( len( reference ), len( per_segment ) ) )
+    mismatches = 0
+    for result, ref in zip( per_segment, reference ):
+        for key in ('data_sha256', 'relocs_sha256'):
+            if result[key] != ref[key]:
+                result['errors'].append( '{} does not match the reference'.format( key ) )
+        mismatches += bool( result['errors'] )
+    return mismatches
+
+
+def segments_digest( per_segment ):
+    h = hashlib.sha256()
+    for x in per_segment:
+        h.update( bytes.fromhex( x['data_sha256'] ) )
+        h.update( bytes.fromhex( x['relocs_sha256'] ) )
+    return h.hexdigest()
+
+
+DESCRIPTION = 'Benchmark the OPTLOADER unpacker and check its output against known-good results.'
+EPILOG = """
+By default, segments are generated with a seeded compressor, so the original data is known and every decompressed segment is checked against it. Use --exe to benchmark the segments of real executables instead, and --reference to check the hashes of every segment against an earlier run (e.g. from before an optimisation).
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=DESCRIPTION, epilog=EPILOG )
+    parser.add_argument( '--exe', nargs='+', help='OPTLOADER compressed executables to take segments from, instead of generating them', required=False )
+    parser.add_argument( '--seed', type=int, default=0, help='Random seed for generated segments (default: 0)', required=False )
+    parser.add_argument( '--segments', type=int, default=200, help='Number of segments to generate (default: 200)', required=False )
+    parser.add_argument( '--min-size', type=int, default=0x200, help='Smallest generated segment in bytes (default: 512)', required=False )
+    parser.add_argument( '--max-size', type=int, default=0x4000, help='Largest generated segment in bytes (default: 16384)', required=False )
+    parser.add_argument( '--repeat', type=int, default=5, help='Number of times to time each segment; the best time is kept (default: 5)', required=False )
+    parser.add_argument( '--no-native', default=False, action='store_true', help="Benchmark the pure Python decoder, even if Numba is installed", required=False )
+    parser.add_argument( '--verify', default=False, action='store_true', help='Check the output of every segment against the pure Python decoder', required=False )
+    parser.add_argument( '--reference', type=argparse.FileType( mode='r' ), help='JSON from an earlier run to check segment hashes against', required=False )
+    parser.add_argument( '--per-segment', default=False, action='store_true', help='Include the results for each segment in the output', required=False )
+    parser.add_argument( '--out-file', type=argparse.FileType( mode='w' ), default=sys.stdout, help='Output JSON file (default: stdout)', required=False )
+    args = parser.parse_args()
+
+    native = not args.no_native and optloader.optloader_native_kernel() is not None
+    config = {'repeat': args.repeat, 'backend': 'native' if native else 'python'}
+    if args.exe:
+        config['exe'] = args.exe
+        segments = [seg for path in args.exe for seg in load_segments( path )]
+    else:
+        config.update( seed=args.seed, segments=args.segments, min_size=args.min_size, max_size=args.max_size )
+        segments = make_segments( args.seed, args.segments, args.min_size, args.max_size )
+        if args.verify:
+            config['escape_segments'] = True
+            segments += make_escape_segments()
+
+    if native:
+        # compile the kernel before anything is timed
+        optloader_decompress( segments[0]['raw'], segments[0]['start_offset']+2, segments[0]['alloc_size'] )
+    results, per_segment = bench_segments( segments, repeat=args.repeat, native=native, verify=args.verify )
+    if args.reference:
+        reference = json.load( args.reference )
+        if 'per_segment' not in reference:
+            parser.error( 'Reference JSON has no per-segment hashes; make it with --per-segment' )
+        check_reference( per_segment, reference['per_segment'] )
+
+    errors = sum( bool( x['errors'] ) for x in per_segment )
+    output = {
+        'python': platform.python_version(),
+        'time': time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+        'config': config,
+        'results': results,
+        'digest': segments_digest( per_segment ),
+        'errors': errors,
+    }
+    if args.per_segment or errors:
+        output['per_segment'] = per_segment
+    json.dump( output, args.out_file, indent=4 )
+    args.out_file.write( '\n' )
+    if errors:
+        sys.exit( 1 )
@@ -1,10 +1,812 @@
 #!/usr/bin/env python
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import array
+import bisect
+import collections
+import contextlib
+import gzip
+import heapq
+import itertools
 import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # print(','.join(['{:d}'.format(ida_segment.get_segm_base(ida_segment.getnseg(i))) for i in range(ida_segment.get_segm_qty())]))
 
+# coverage logs are read in chunks of this many bytes
+CHUNK_SIZE = 16*1024*1024
+
+# hot loops repeat the same few addresses millions of times, so translated
+# lines are memoised. the memo is dropped if it grows past this many entries.
+MAX_CACHE_LINES = 1 << 20
+
+# drcov output: header versions as written by DynamoRIO, fake module load
+# addresses, and a basic block record of start offset, size, module ID
+DRCOV_VERSION = 2
+DRCOV_FLAVOR = 'drcov'
+DRCOV_MODULE_TABLE_VERSION = 2
+DRCOV_MODULE_BASE = 0x10000
+DRCOV_MODULE_ALIGN = 0x10000
+DRCOV_BB_ENTRY = struct.Struct( '<IHH' )
+
+# binary coverage traces written by pack_log.py, holding the seg:offset records
+# of a coverage log in blocks. everything is little-endian
+TRACE_MAGIC = b'LOGB'
+TRACE_VERSION = 1
+# magic, version, flags (unused), record count, offset of the block index
+TRACE_HEADER = struct.Struct( '<4sHHQQ' )
+# the index is a TRACE_COUNT, then for each block: file offset, record count,
+# size, encoding, and whether offsets are 32 bits wide instead of 16
+TRACE_INDEX_ENTRY = struct.Struct( '<QIIBB2x' )
+TRACE_COUNT = struct.Struct( '<I' )
+# every selector (16 bits), then every offset
+TRACE_RAW = 0
+# a count of runs of the same record, the selector and offset of each run,
+# then the length of each run (32 bits)
+TRACE_RLE = 1
+# counts of selector runs and escapes, the selector and length of each run,
+# then a signed byte per record with the change from the previous offset
+TRACE_DELTA = 2
+# marks a record in a TRACE_DELTA block (always the first) whose offset comes
+# from the escapes at the end of the block
+TRACE_ESCAPE = -128
+# blocks start on a multiple of this, so the arrays in them can be mapped in place
+TRACE_ALIGN = 8
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# CoverageCounter keeps hits for offsets below this in a flat array per
+# selector; anything past it (e.g. a stray 32-bit offset) goes in a dict
+COUNTER_ARRAY_LIMIT = 0x10000
+
+# DOSBox writes every line as SSSS:OOOOOOOO\n; the NumPy path only handles
+# chunks that are entirely in this layout.
+LINE_WIDTH = 14
+LINE_DIGITS = [0, 1, 2, 3, 5, 6, 7, 8, 9, 10, 11, 12]
+
+if numpy:
+    # ASCII to hex digit value, 0xff for anything else. lowercase digits are
+    # left out on purpose; selectors only match the uppercase segment map keys.
+    HEX_VALUES = numpy.full( 256, 0xff, dtype=numpy.uint8 )
+    HEX_VALUES[numpy.frombuffer( b'0123456789ABCDEF', dtype=numpy.uint8 )] = numpy.arange( 16, dtype=numpy.uint8 )
+    HEX_LOWER = numpy.frombuffer( b'0123456789abcdef', dtype=numpy.uint8 )
+    HEX_UPPER = numpy.frombuffer( b'0123456789ABCDEF', dtype=numpy.uint8 )
+    HEX_SHIFTS = numpy.array( [12, 8, 4, 0, 28, 24, 20, 16, 12, 8, 4, 0], dtype=numpy.uint32 )
+
+
+# wrap a coverage log stream, decompressing gzip or zstd (needs zstandard) if
+# the magic number matches
+def open_coverage_log( fin ):
+    magic = fin.peek( 4 )[:4]
+    if magic.startswith( GZIP_MAGIC ):
+        return gzip.GzipFile( fileobj=fin, mode='rb' )
+    elif magic == ZSTD_MAGIC:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError( 'Coverage log is zstd compressed, but the zstandard module is not installed' )
+        return zstandard.ZstdDecompressor().stream_reader( fin )
+    return fin
+
+
+# read a binary stream in big chunks ending on a line boundary, with \r\n
+# replaced by \n. yields (chunk, terminated); terminated is only False for a
+# last line with no newline. size stops after that many bytes
+def read_chunks( fin, chunk_size=CHUNK_SIZE, size=None ):
+    remainder = b''
+    while size is None or size > 0:
+        chunk = fin.read( chunk_size if size is None else min( chunk_size, size ) )
+        if not chunk:
+            break
+        if size is not None:
+            size -= len( chunk )
+        chunk = remainder + chunk
+        end = chunk.rfind( b'\n' )
+        if end == -1:
+            remainder = chunk
+            continue
+        remainder = chunk[end+1:]
+        chunk = chunk[:end+1]
+        if b'\r' in chunk:
+            chunk = chunk.replace( b'\r\n', b'\n' )
+        yield chunk, True
+    if remainder:
+        yield remainder, False
+
+
+def split_chunk( chunk, terminated ):
+    if terminated:
+        chunk = chunk[:-1]
+    return chunk.split( b'\n' )
+
+
+# like read_chunks, but yields (lines, terminated) with line endings stripped
+def read_lines( fin, chunk_size=CHUNK_SIZE ):
+    for chunk, terminated in read_chunks( fin, chunk_size=chunk_size ):
+        yield split_chunk( chunk, terminated ), terminated
+
+
+# parse a chunk of fixed-width log lines, returns (rows, selectors, offsets),
+# or None if the chunk isn't in the fixed-width layout
+def parse_chunk_numpy( chunk ):
+    if len( chunk ) % LINE_WIDTH:
+        return None
+    rows = numpy.frombuffer( chunk, dtype=numpy.uint8 ).reshape( -1, LINE_WIDTH )
+    if (rows[:, 4] != ord( ':' )).any() or (rows[:, 13] != ord( '\n' )).any():
+        return None
+    digits = HEX_VALUES[rows[:, LINE_DIGITS]]
+    if (digits > 0xf).any():
+        return None
+    values = digits.astype( numpy.uint32 ) << HEX_SHIFTS
+    selectors = numpy.bitwise_or.reduce( values[:, :4], axis=1 )
+    offsets = numpy.bitwise_or.reduce( values[:, 4:], axis=1 )
+    return rows, selectors, offsets
+
+
+# format addresses as fixed-width prefix+offset lines, one row of bytes per line
+def format_numpy( addresses, prefix ):
+    prefix = numpy.frombuffer( prefix, dtype=numpy.uint8 )
+    output = numpy.empty( (len( addresses ), len( prefix )+9), dtype=numpy.uint8 )
+    output[:, :len( prefix )] = prefix
+    for i in range( 8 ):
+        output[:, len( prefix )+i] = HEX_LOWER[(addresses >> (28 - 4*i)) & 0xf]
+    output[:, -1] = ord( '\n' )
+    return output
+
+
+# format selectors and offsets as DOSBox SSSS:OOOOOOOO rows, like parse_chunk_numpy
+def format_log_rows( selectors, offsets ):
+    output = numpy.empty( (len( selectors ), LINE_WIDTH), dtype=numpy.uint8 )
+    for i in range( 4 ):
+        output[:, i] = HEX_UPPER[(selectors >> (12 - 4*i)) & 0xf]
+    output[:, 4] = ord( ':' )
+    for i in range( 8 ):
+        output[:, 5+i] = HEX_UPPER[(offsets >> (28 - 4*i)) & 0xf]
+    output[:, 13] = ord( '\n' )
+    return output
+
+
+# a decoded block of a binary coverage trace, in place of a chunk of text.
+# size is the number of bytes the block takes up in the file.
+TraceChunk = collections.namedtuple( 'TraceChunk', ['selectors', 'offsets', 'size'] )
+
+
+# load little-endian values from a trace into an array
+def trace_array( typecode, data ):
+    result = array.array( typecode, bytes( data ) )
+    if sys.byteorder == 'big' and result.itemsize > 1:
+        result.byteswap()
+    return result
+
+
+# reader for binary coverage traces; blocks are only decoded when they're read,
+# so data is best given as an mmap
+class TraceReader:
+    def __init__( self, data ):
+        if len( data ) < TRACE_HEADER.size:
+            raise ValueError( 'Coverage trace is too short' )
+        magic, version, flags, count, index_offset = TRACE_HEADER.unpack_from( data )
+        if magic != TRACE_MAGIC:
+            raise ValueError( 'Not a binary coverage trace' )
+        if version != TRACE_VERSION:
+            raise ValueError( 'Unsupported coverage trace version {}'.format( version ) )
+        self.data = data
+        self.count = count
+        block_count, = TRACE_COUNT.unpack_from( data, index_offset )
+        self.index = [TRACE_INDEX_ENTRY.unpack_from( data, index_offset+TRACE_COUNT.size+i*TRACE_INDEX_ENTRY.size ) for i in range( block_count )]
+
+    def __len__( self ):
+        return self.count
+
+    # decode block n into uint32 arrays of selectors and offsets
+    def decode_numpy( self, n ):
+        offset, count, size, encoding, wide = self.index[n]
+        offset_type = numpy.dtype( '<u4' if wide else '<u2' )
+        data = self.data
+
+        def take( dtype, length ):
+            nonlocal offset
+            result = numpy.frombuffer( data, dtype=dtype, count=length, offset=offset )
+            offset += result.nbytes
+            return result
+
+        if encoding == TRACE_RAW:
+            selectors = take( '<u2', count )
+            offsets = take( offset_type, count )
+        elif encoding == TRACE_RLE:
+            runs = int( take( '<u4', 1 )[0] )
+            run_selectors = take( '<u2', runs )
+            run_offsets = take( offset_type, runs )
+            lengths = take( '<u4', runs )
+            selectors = numpy.repeat( run_selectors, lengths )
+            offsets = numpy.repeat( run_offsets, lengths )
+        elif encoding == TRACE_DELTA:
+            runs, escape_count = take( '<u4', 2 ).tolist()
+            run_selectors = take( '<u2', runs )
+            lengths = take( '<u4', runs )
+            deltas = take( 'i1', count )
+            escapes = take( offset_type, escape_count )
+            selectors = numpy.repeat( run_selectors, lengths )
+            # add up the deltas, restarting from the full offset at each escape
+            escaped = deltas == TRACE_ESCAPE
+            totals = numpy.cumsum( numpy.where( escaped, 0, deltas ), dtype=numpy.int64 )
+            positions = numpy.flatnonzero( escaped )
+            bases = numpy.zeros( count, dtype=numpy.int64 )
+            bases[positions] = escapes.astype( numpy.int64 ) - totals[positions]
+            last_escape = numpy.maximum.accumulate( numpy.where( escaped, numpy.arange( count ), 0 ) )
+            offsets = bases[last_escape] + totals
+        else:
+            raise ValueError( 'Unknown encoding {} for coverage trace block {}'.format( encoding, n ) )
+        if len( selectors ) != count or len( offsets ) != count:
+            raise ValueError( 'Coverage trace block {} is corrupt'.format( n ) )
+        return selectors.astype( numpy.uint32 ), offsets.astype( numpy.uint32 )
+
+    # decode block n into lists of selectors and offsets, without NumPy
+    def decode( self, n ):
+        offset, count, size, encoding, wide = self.index[n]
+        offset_type, offset_size = ('I', 4) if wide else ('H', 2)
+        data = self.data
+
+        def take( typecode, itemsize, length ):
+            nonlocal offset
+            result = trace_array( typecode, data[offset:offset+itemsize*length] )
+            offset += itemsize*length
+            return result
+
+        if encoding == TRACE_RAW:
+            selectors = take( 'H', 2, count ).tolist()
+            offsets = take( offset_type, offset_size, count ).tolist()
+        elif encoding == TRACE_RLE:
+            runs, = take( 'I', 4, 1 )
+            run_records = list( zip( take( 'H', 2, runs ), take( offset_type, offset_size, runs ) ) )
+            lengths = take( 'I', 4, runs )
+            records = [x for record, length in zip( run_records, lengths ) for x in itertools.repeat( record, length )]
+            selectors = [x[0] for x in records]
+            offsets = [x[1] for x in records]
+        elif encoding == TRACE_DELTA:
+            runs, escape_count = take( 'I', 4, 2 )
+            run_selectors = take( 'H', 2, runs )
+            lengths = take( 'I', 4, runs )
+            deltas = take( 'b', 1, count )
+            escapes = iter( take( offset_type, offset_size, escape_count ) )
+            selectors = [x for selector, length in zip( run_selectors, lengths ) for x in itertools.repeat( selector, length )]
+            offsets = []
+            current = 0
+            for delta in deltas:
+                current = next( escapes ) if delta == TRACE_ESCAPE else current+delta
+                offsets.append( current )
+        else:
+            raise ValueError( 'Unknown encoding {} for coverage trace block {}'.format( encoding, n ) )
+        if len( selectors ) != count or len( offsets ) != count:
+            raise ValueError( 'Coverage trace block {} is corrupt'.format( n ) )
+        return selectors, offsets
+
+    # yield (chunk, terminated) for blocks start to end, like read_chunks; chunks
+    # are TraceChunks with use_numpy, otherwise lines of text
+    def chunks( self, start=0, end=None, use_numpy=True ):
+        for n in range( start, len( self.index ) if end is None else end ):
+            if use_numpy and numpy:
+                yield TraceChunk( *self.decode_numpy( n ), self.index[n][2] ), True
+            else:
+                yield b''.join( b'%04X:%08X\n' % x for x in zip( *self.decode( n ) ) ), True
+
+    # split the blocks into (start, end) ranges with about the same number of records
+    def shards( self, shards ):
+        totals = list( itertools.accumulate( x[1] for x in self.index ) )
+        bounds = [0]
+        for i in range( 1, shards ):
+            n = bisect.bisect_left( totals, self.count*i//shards )+1
+            if bounds[-1] < n < len( self.index ):
+                bounds.append( n )
+        bounds.append( len( self.index ) )
+        return [(bounds[i], bounds[i+1]) for i in range( len( bounds )-1 ) if bounds[i] < bounds[i+1]]
+
+
+# open a binary trace from a stream (mmapped if it's a regular file), or None if
+# it isn't one
+def map_trace( fin ):
+    if fin.peek( len( TRACE_MAGIC ) )[:len( TRACE_MAGIC )] != TRACE_MAGIC:
+        return None
+    path = log_path( fin )
+    if path:
+        with open( path, 'rb' ) as f:
+            return TraceReader( mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) )
+    return TraceReader( fin.read() )
+
+
+# translates DOSBox seg:offset coverage lines to Lighthouse format. seg_info
+# can be a list of segment maps, to translate several modules at once
+class LogConverter:
+    def __init__( self, seg_info, human=False, no_filter=False, use_numpy=True ):
+        seg_infos = [seg_info] if isinstance( seg_info, dict ) else seg_info
+        self.modules = []
+        self.seg_map = {}
+        for info in seg_infos:
+            if info['module'] in self.modules:
+                raise ValueError( 'Segment map for module {} was given twice'.format( info['module'] ) )
+            self.modules.append( info['module'] )
+            for x in info['segments']:
+                if x['selector'] in self.seg_map:
+                    raise ValueError( 'Selector {} is in the segment maps for both {} and {}'.format( x['selector'], self.seg_map[x['selector']]['module'], info['module'] ) )
+                self.seg_map[x['selector']] = dict( x, module=info['module'] )
+        self.human = human
+        self.no_filter = no_filter
+        self.caches = {}
+        self.ida_offsets = None
+        self.module_ids = None
+        if numpy and use_numpy:
+            # selector to ida_offset and index into modules, -1 for selectors
+            # not in the segment map
+            self.ida_offsets = numpy.full( 0x10000, -1, dtype=numpy.int64 )
+            self.module_ids = numpy.full( 0x10000, -1, dtype=numpy.int16 )
+            for seg, info in self.seg_map.items():
+                if len( seg ) == 4 and all( x in '0123456789ABCDEF' for x in seg ):
+                    self.ida_offsets[int( seg, 16 )] = info['ida_offset']
+                    self.module_ids[int( seg, 16 )] = self.modules.index( info['module'] )
+
+    def format_address( self, seg, offset ):
+        info = self.seg_map[seg]
+        if self.human:
+            result = '{}:{:04X} => {}+{}:{:04X}\n'.format( seg, offset, info['module'], info['ida_selector'], offset )
+        else:
+            result = '{}+{:08x}\n'.format( info['module'], info['ida_offset']+offset )
+        return result.encode( 'utf-8' )
+
+    def parse( self, line ):
+        seg, sep, offset = line.partition( b':' )
+        if not sep:
+            raise ValueError( 'Malformed coverage log line: {}'.format( line ) )
+        return seg.decode( 'latin-1' ), int( offset, 16 )
+
+    # translate a single line, only for module if given
+    def translate( self, line, newline=True, module=None ):
+        seg, offset = self.parse( line )
+        if seg in self.seg_map:
+            if module is None or self.seg_map[seg]['module'] == module:
+                return self.format_address( seg, offset )
+        elif self.no_filter and module is None:
+            return line + b'\n' if newline else line
+        return b''
+
+    def convert( self, lines, terminated=True, module=None ):
+        if not terminated:
+            return b''.join( self.translate( x, newline=False, module=module ) for x in lines )
+
+        cache = self.caches.setdefault( module, {} )
+        if len( cache ) > MAX_CACHE_LINES:
+            cache.clear()
+        results = list( map( cache.get, lines ) )
+        if None in results:
+            for i, result in enumerate( results ):
+                if result is None:
+                    result = cache.get( lines[i] )
+                    if result is None:
+                        result = self.translate( lines[i], module=module )
+                        cache[lines[i]] = result
+                    results[i] = result
+        return b''.join( results )
+
+    # translate a terminated chunk in bulk, or None if it has to go the slow way
+    def convert_numpy( self, chunk, module=None ):
+        if self.ida_offsets is None or self.human:
+            return None
+        parsed = parse_chunk_numpy( chunk )
+        if parsed is None:
+            return None
+        return self.convert_arrays( *parsed, module=module )
+
+    # translate arrays of selectors and offsets in bulk, or None if they have to go
+    # the slow way. rows passes through unmapped lines; if None they're formatted
+    def convert_arrays( self, rows, selectors, offsets, module=None ):
+        if self.ida_offsets is None or self.human:
+            return None
+        ids = self.module_ids[selectors]
+        if module is None:
+            mask = ids >= 0
+        else:
+            mask = ids == self.modules.index( module )
+        addresses = self.ida_offsets[selectors[mask]] + offsets[mask]
+        if len( addresses ) and addresses.max() > 0xffffffff:
+            return None
+        ids = ids[mask]
+        passthrough = self.no_filter and module is None and not mask.all()
+
+        if not passthrough and (len( ids ) == 0 or (ids == ids[0]).all()):
+            if len( ids ) == 0:
+                return b''
+            return format_numpy( addresses, '{}+'.format( self.modules[ids[0]] ).encode( 'utf-8' ) ).tobytes()
+
+        # lines are different widths, so scatter each group into place
+        prefixes = ['{}+'.format( x ).encode( 'utf-8' ) for x in self.modules]
+        widths = numpy.zeros( len( selectors ), dtype=numpy.int64 )
+        widths[mask] = numpy.array( [len( x )+9 for x in prefixes], dtype=numpy.int64 )[ids]
+        if passthrough:
+            widths[~mask] = LINE_WIDTH
+        starts = numpy.cumsum( widths ) - widths
+        result = numpy.empty( widths.sum(), dtype=numpy.uint8 )
+        for i, prefix in enumerate( prefixes ):
+            group = ids == i
+            if group.any():
+                output = format_numpy( addresses[group], prefix )
+                result[starts[mask][group][:, None] + numpy.arange( output.shape[1] )] = output
+        if passthrough:
+            unmapped = rows[~mask] if rows is not None else format_log_rows( selectors[~mask], offsets[~mask] )
+            result[starts[~mask][:, None] + numpy.arange( LINE_WIDTH )] = unmapped
+        return result.tobytes()
+
+    # translate a chunk from read_chunks; module limits the output to one module,
+    # otherwise addresses are tagged with their module name
+    def convert_chunk( self, chunk, terminated=True, module=None ):
+        if isinstance( chunk, TraceChunk ):
+            result = self.convert_arrays( None, chunk.selectors, chunk.offsets, module=module )
+            if result is not None:
+                return result
+            chunk = format_log_rows( chunk.selectors, chunk.offsets ).tobytes()
+        if terminated:
+            result = self.convert_numpy( chunk, module=module )
+            if result is not None:
+                return result
+        return self.convert( split_chunk( chunk, terminated ), terminated, module=module )
+
+
+# collapses coverage lines into unique addresses with hit counts. hits for
+# mapped selectors are kept in an array indexed by offset, up to
+# COUNTER_ARRAY_LIMIT; with no_filter, other selectors are counted per raw line
+class CoverageCounter:
+    def __init__( self, converter ):
+        self.converter = converter
+        self.counters = {}
+        self.far_counters = collections.defaultdict( collections.Counter )
+        self.unfiltered = collections.Counter()
+
+    def add_hits( self, seg, offset, hits ):
+        counter = self.counters.get( seg )
+        if counter is None:
+            counter = array.array( 'Q', bytes( 8*min( max( self.converter.seg_map[seg]['alloc_size'], 1 ), COUNTER_ARRAY_LIMIT ) ) )
+            self.counters[seg] = counter
+        if offset >= COUNTER_ARRAY_LIMIT:
+            self.far_counters[seg][offset] += hits
+            return
+        if offset >= len( counter ):
+            counter.extend( bytes( 8*(offset + 1 - len( counter )) ) )
+        counter[offset] += hits
+
+    def add( self, lines ):
+        seg_map = self.converter.seg_map
+        for line, hits in collections.Counter( lines ).items():
+            seg, offset = self.converter.parse( line )
+            if seg in seg_map:
+                self.add_hits( seg, offset, hits )
+            elif self.converter.no_filter:
+                self.unfiltered[line] += hits
+
+    # count a terminated chunk in bulk, False if it has to go the slow way
+    def add_numpy( self, chunk ):
+        if self.converter.ida_offsets is None:
+            return False
+        parsed = parse_chunk_numpy( chunk )
+        if parsed is None:
+            return False
+        return self.add_arrays( *parsed )
+
+    # count arrays of selectors and offsets in bulk, False if they have to go the
+    # slow way. rows is used for counting unmapped lines; if None they're formatted
+    def add_arrays( self, rows, selectors, offsets ):
+        ida_offsets = self.converter.ida_offsets
+        if ida_offsets is None:
+            return False
+        mask = ida_offsets[selectors] >= 0
+        keys = (selectors[mask].astype( numpy.uint64 ) << 32) | offsets[mask]
+        keys, hits = numpy.unique( keys, return_counts=True )
+        for key, count in zip( keys.tolist(), hits.tolist() ):
+            self.add_hits( '{:04X}'.format( key >> 32 ), key & 0xffffffff, count )
+        if self.converter.no_filter and not mask.all():
+            unmapped = rows[~mask] if rows is not None else format_log_rows( selectors[~mask], offsets[~mask] )
+            lines = numpy.ascontiguousarray( unmapped[:, :LINE_WIDTH-1] ).view( 'S{}'.format( LINE_WIDTH-1 ) ).ravel()
+            lines, hits = numpy.unique( lines, return_counts=True )
+            for line, count in zip( lines.tolist(), hits.tolist() ):
+                self.unfiltered[line] += count
+        return True
+
+    def add_chunk( self, chunk, terminated=True ):
+        if isinstance( chunk, TraceChunk ):
+            if self.add_arrays( None, chunk.selectors, chunk.offsets ):
+                return
+            chunk = format_log_rows( chunk.selectors, chunk.offsets ).tobytes()
+        if not (terminated and self.add_numpy( chunk )):
+            self.add( split_chunk( chunk, terminated ) )
+
+    def entries( self ):
+        result = [(seg, offset, hits) for seg, counter in self.counters.items() for offset, hits in enumerate( counter ) if hits]
+        result.extend( (seg, offset, hits) for seg, counter in self.far_counters.items() for offset, hits in counter.items() )
+        return result
+
+    def merge( self, entries, unfiltered ):
+        for seg, offset, hits in entries:
+            self.add_hits( seg, offset, hits )
+        self.unfiltered.update( unfiltered )
+
+    # yield ((module index, ida_address), seg, offset, hits) for a selector
+    def addresses( self, seg ):
+        counter = self.counters[seg]
+        info = self.converter.seg_map[seg]
+        module_id = self.converter.modules.index( info['module'] )
+        base = info['ida_offset']
+        for offset in range( len( counter ) ):
+            if counter[offset]:
+                yield (module_id, base+offset), seg, offset, counter[offset]
+        far_counter = self.far_counters.get( seg, {} )
+        for offset in sorted( far_counter ):
+            yield (module_id, base+offset), seg, offset, far_counter[offset]
+
+    # combine sorted entries from selectors that map to the same IDA address, which
+    # happens when an offset runs past the end of its segment
+    @staticmethod
+    def merge_aliases( entries ):
+        for address, group in itertools.groupby( entries, key=lambda x: x[0] ):
+            group = list( group )
+            yield address, group[0][1], group[0][2], sum( x[3] for x in group )
+
+    # yield the unique addresses, sorted by module and IDA address, then any
+    # unfiltered lines
+    def output( self, counts=False, module=None ):
+        converter = self.converter
+        segs = [x for x in self.counters if module is None or converter.seg_map[x]['module'] == module]
+        merged = heapq.merge( *(self.addresses( seg ) for seg in segs) )
+        if not converter.human:
+            merged = self.merge_aliases( merged )
+        for address, seg, offset, hits in merged:
+            result = converter.format_address( seg, offset )
+            if counts:
+                result = result[:-1] + ' {}\n'.format( hits ).encode( 'utf-8' )
+            yield result
+        if module is not None:
+            return
+        for line in sorted( self.unfiltered ):
+            if counts:
+                yield line + ' {}\n'.format( self.unfiltered[line] ).encode( 'utf-8' )
+            else:
+                yield line + b'\n'
+
+    # size of each module's IDA address space, in module order
+    def module_sizes( self ):
+        sizes = [0]*len( self.converter.modules )
+        for info in self.converter.seg_map.values():
+            module_id = self.converter.modules.index( info['module'] )
+            sizes[module_id] = max( sizes[module_id], info['ida_offset'] + math.ceil( info['alloc_size']/16 )*16 )
+        return sizes
+
+    # write the addresses hit as a drcov file. the log only has the start of each
+    # instruction, so each one gets a 1 byte block of its own, which Lighthouse maps
+    # back to the whole instruction; joining them would mean guessing
+    def write_drcov( self, fout ):
+        modules = self.converter.modules
+        lines = [
+            'DRCOV VERSION: {}'.format( DRCOV_VERSION ),
+            'DRCOV FLAVOR: {}'.format( DRCOV_FLAVOR ),
+            'Module Table: version {}, count {}'.format( DRCOV_MODULE_TABLE_VERSION, len( modules ) ),
+            'Columns: id, base, end, entry, checksum, timestamp, path',
+        ]
+        # the modules don't have real load addresses, so lay them out end to end
+        base = DRCOV_MODULE_BASE
+        for module_id, (module, size) in enumerate( zip( modules, self.module_sizes() ) ):
+            lines.append( '{:3}, 0x{:016x}, 0x{:016x}, 0x{:016x}, 0x{:08x}, 0x{:08x}, {}'.format( module_id, base, base+size, 0, 0, 0, module ) )
+            base += -(-size // DRCOV_MODULE_ALIGN)*DRCOV_MODULE_ALIGN
+        merged = self.merge_aliases( heapq.merge( *(self.addresses( seg ) for seg in self.counters) ) )
+        records = b''.join( DRCOV_BB_ENTRY.pack( address, 1, module_id ) for (module_id, address), seg, offset, hits in merged )
+        count = len( records )//DRCOV_BB_ENTRY.size
+        lines.append( 'BB Table: {} bbs'.format( count ) )
+        fout.write( ''.join( x+'\n' for x in lines ).encode( 'utf-8' ) )
+        fout.write( records )
+        return count
+
+
+# path of the regular file behind a stream, or None; workers open the log by
+# path, so pipes and redirected stdin can't be sharded
+def log_path( fin ):
+    name = getattr( fin, 'name', None )
+    try:
+        if isinstance( name, str ) and fin.seekable() and os.path.samestat( os.fstat( fin.fileno() ), os.stat( name ) ):
+            return name
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# split a seekable log into newline-aligned (start, end) byte ranges; there may
+# be fewer than shards if the log is short
+def shard_log( fin, shards ):
+    size = fin.seek( 0, os.SEEK_END )
+    bounds = [0]
+    for i in range( 1, shards ):
+        pos = size*i//shards
+        if pos <= bounds[-1]:
+            continue
+        # move forward to just after the next newline
+        fin.seek( pos-1 )
+        fin.readline()
+        if bounds[-1] < fin.tell() < size:
+            bounds.append( fin.tell() )
+    bounds.append( size )
+    fin.seek( 0 )
+    return [(bounds[i], bounds[i+1]) for i in range( len( bounds )-1 ) if bounds[i] < bounds[i+1]]
+
+
+# pass chunks through, adding their bytes and lines to counters
+def count_chunks( chunks, counters ):
+    for chunk, terminated in chunks:
+        if isinstance( chunk, TraceChunk ):
+            counters['bytes'] += chunk.size
+            counters['lines'] += len( chunk.selectors )
+        else:
+            counters['bytes'] += len( chunk )
+            counters['lines'] += chunk.count( b'\n' ) + (not terminated)
+        yield chunk, terminated
+
+
+# yield (chunk, terminated) from a log stream or a TraceReader; start and end
+# are byte offsets in a log, or block numbers in a trace
+def log_chunks( source, start=None, end=None, options=None, counters=None ):
+    chunk_size = options['chunk_size'] if options else CHUNK_SIZE
+    if isinstance( source, TraceReader ):
+        use_numpy = options['converter']['use_numpy'] if options else True
+        chunks = source.chunks( start or 0, end, use_numpy=use_numpy )
+    else:
+        if start is not None:
+            source.seek( start )
+        chunks = read_chunks( source, chunk_size=chunk_size, size=None if end is None else end-(start or 0) )
+    if counters is not None:
+        chunks = count_chunks( chunks, counters )
+    return chunks
+
+
+def new_counters():
+    return {'bytes': 0, 'lines': 0, 'output_lines': 0}
+
+
+# worker: convert a byte range of a log (or blocks of a trace), writing each
+# module of targets to its path. returns counters with options['stats']
+def convert_shard( path, start, end, seg_info, options, targets ):
+    converter = LogConverter( seg_info, **options['converter'] )
+    counters = new_counters() if options['stats'] else None
+    outputs = [(module, open( target, 'wb' )) for module, target in targets]
+    with open( path, 'rb' ) as fin:
+        source = map_trace( fin ) if options['trace'] else fin
+        for chunk, terminated in log_chunks( source, start, end, options, counters ):
+            for module, stream in outputs:
+                output = converter.convert_chunk( chunk, terminated, module=module )
+                stream.write( output )
+                if counters is not None:
+                    counters['output_lines'] += output.count( b'\n' )
+    for module, stream in outputs:
+        stream.close()
+    return counters
+
+
+# worker: count the addresses in a byte range of a log (or blocks of a trace).
+# returns (entries, unfiltered) for CoverageCounter.merge, and counters
+def count_shard( path, start, end, seg_info, options ):
+    counter = CoverageCounter( LogConverter( seg_info, **options['converter'] ) )
+    counters = new_counters() if options['stats'] else None
+    with open( path, 'rb' ) as fin:
+        source = map_trace( fin ) if options['trace'] else fin
+        for chunk, terminated in log_chunks( source, start, end, options, counters ):
+            counter.add_chunk( chunk, terminated )
+    return counter.entries(), counter.unfiltered, counters
+
+
+# convert a DOSBox coverage log or binary trace to Lighthouse format. fout can
+# be a dict of module name to stream, to split the output per module. jobs only
+# applies to uncompressed log files and traces; stats is filled in if given
+def convert_log( fin, fout, seg_info, human=False, no_filter=False, unique=False, counts=False, use_numpy=True, jobs=1, chunk_size=CHUNK_SIZE, stats=None, drcov=False ):
+    start_time = time.perf_counter()
+    converter = LogConverter( seg_info, human=human, no_filter=no_filter, use_numpy=use_numpy )
+    counters = new_counters() if stats is not None else None
+    timings = {}
+    outputs = list( fout.items() ) if isinstance( fout, dict ) else [(None, fout)]
+    trace = map_trace( fin )
+    source = open_coverage_log( fin ) if trace is None else trace
+    options = {
+        'converter': {'human': human, 'no_filter': no_filter, 'use_numpy': use_numpy},
+        'chunk_size': chunk_size,
+        'stats': stats is not None,
+        'trace': trace is not None,
+    }
+
+    shards = []
+    path = log_path( fin ) if jobs > 1 and (trace is not None or source is fin) else None
+    if path:
+        shards = trace.shards( jobs ) if trace is not None else shard_log( fin, jobs )
+    count = len( shards )
+    if count > 1:
+        shard_args = ([path]*count, [x[0] for x in shards], [x[1] for x in shards], [seg_info]*count, [options]*count)
+
+    if unique or counts or drcov:
+        counter = CoverageCounter( converter )
+        if count > 1:
+            with ProcessPoolExecutor( max_workers=jobs ) as pool:
+                for entries, unfiltered, shard_counters in pool.map( count_shard, *shard_args ):
+                    counter.merge( entries, unfiltered )
+                    if counters is not None:
+                        for key, value in shard_counters.items():
+                            counters[key] += value
+        else:
+            for chunk, terminated in log_chunks( source, options=options, counters=counters ):
+                counter.add_chunk( chunk, terminated )
+        timings['convert'] = time.perf_counter()-start_time
+        if drcov:
+            blocks = counter.write_drcov( outputs[0][1] )
+            if counters is not None:
+                counters['blocks'] = blocks
+        else:
+            for module, stream in outputs:
+                lines = counter.output( counts=counts, module=module )
+                if counters is not None:
+                    lines = list( lines )
+                    counters['output_lines'] += len( lines )
+                stream.writelines( lines )
+        timings['output'] = time.perf_counter()-start_time-timings['convert']
+        if counters is not None:
+            counters['translated_lines'] = sum( sum( x ) for x in counter.counters.values() )
+
+    elif count > 1:
+        # each worker writes its shard to temporary files, which are then
+        # concatenated in order
+        with tempfile.TemporaryDirectory() as temp_dir:
+            targets = [[(module, os.path.join( temp_dir, '{}_{}.txt'.format( i, j ) )) for j, (module, _) in enumerate( outputs )] for i in range( count )]
+            with ProcessPoolExecutor( max_workers=jobs ) as pool:
+                for shard_counters in pool.map( convert_shard, *shard_args, targets ):
+                    if counters is not None:
+                        for key, value in shard_counters.items():
+                            counters[key] += value
+            for shard_targets in targets:
+                for (_, target), (_, stream) in zip( shard_targets, outputs ):
+                    with open( target, 'rb' ) as f:
+                        shutil.copyfileobj( f, stream, CHUNK_SIZE )
+
+    else:
+        for chunk, terminated in log_chunks( source, options=options, counters=counters ):
+            for module, stream in outputs:
+                output = converter.convert_chunk( chunk, terminated, module=module )
+                stream.write( output )
+                if counters is not None:
+                    counters['output_lines'] += output.count( b'\n' )
+
+    if stats is not None:
+        elapsed = time.perf_counter()-start_time
+        timings.setdefault( 'convert', elapsed )
+        if not (unique or counts or drcov) and not no_filter:
+            # every output line is a translated address
+            counters['translated_lines'] = counters['output_lines']
+        translated = counters.get( 'translated_lines' )
+        stats.update( {
+            'tool': 'convert_log',
+            'elapsed': round( elapsed, 6 ),
+            'timings': {k: round( v, 6 ) for k, v in timings.items()},
+            'counters': dict( counters, shards=max( count, 1 ), numpy=converter.ida_offsets is not None ),
+            'rates': {
+                'lines_per_s': round( counters['lines']/elapsed, 1 ) if elapsed else None,
+                'mb_per_s': round( counters['bytes']/elapsed/1e6, 3 ) if elapsed else None,
+                # fraction of lines with an address in one of the modules
+                'filter_hit_rate': round( translated/counters['lines'], 6 ) if translated is not None and counters['lines'] else None,
+            },
+        } )
+
+
 DESCRIPTION = 'Convert a DOSBox coverage map into Lighthouse module+offset format.'
 EPILOG = """
 IDA Pro uses a fake 32-bit memory map to lay out 16-bit code. In order to use a CPU coverage map from DOSBox with Lighthouse, addresses need to be converted from seg:offset_16 format to module+offset_32.
@@ -12,39 +814,44 @@ IDA Pro uses a fake 32-bit memory map to lay out 16-bit code. In order to use a
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser( description=DESCRIPTION, epilog=EPILOG )
-    parser.add_argument( 'segments', type=argparse.FileType( mode='r' ), help='Segment map JSON generated by get_segtable.py' )
-    parser.add_argument( 'coverage_log', type=argparse.FileType( mode='r' ), help='Coverage log taken from DOSBox: LOGC [num of instructions]' )
-    parser.add_argument( '--out-file', type=argparse.FileType( mode='w' ), help='Output Lighthouse coverage file (default: stdout)', required=False )
+    parser.add_argument( 'segments', type=argparse.FileType( mode='r' ), nargs='+', help='Segment map JSON generated by get_segtable.py. Pass several (or a JSON list of segment maps) to convert multiple modules at once' )
+    parser.add_argument( 'coverage_log', type=argparse.FileType( mode='rb' ), help='Coverage log taken from DOSBox: LOGC [num of instructions]. Can be gzip or zstd compressed, or "-" for stdin' )
+    parser.add_argument( '--out-file', type=argparse.FileType( mode='wb' ), help='Output Lighthouse coverage file (default: stdout)', required=False )
+    parser.add_argument( '--out-dir', help='Write a separate Lighthouse coverage file for each module to this directory, named [module].txt', required=False )
     parser.add_argument( '--no-filter', default=False, action='store_true', help='Include non-transformed lines in output', required=False )
+    parser.add_argument( '--unique', default=False, action='store_true', help='Output each address once, in address order', required=False )
+    parser.add_argument( '--counts', default=False, action='store_true', help='Output each address once, followed by the number of times it was hit', required=False )
+    parser.add_argument( '--jobs', type=int, default=1, help='Number of worker processes to split an uncompressed coverage log across (default: 1)', required=False )
+    parser.add_argument( '--no-numpy', default=False, action='store_true', help='Always use the pure Python converter, even if NumPy is installed', required=False )
     parser.add_argument( '--human', default=False, action='store_true', help='Output as human-readable IDA offsets', required=False )
+    parser.add_argument( '--drcov', default=False, action='store_true', help='Output the executed instructions as a binary drcov file, which Lighthouse loads much faster', required=False )
+    parser.add_argument( '--stats', metavar='STATS_FILE', help='Write timings and counters for the run to this JSON file ("-" for stderr)', required=False )
     args = parser.parse_args()
 
-    seg_info = json.load( args.segments )
-    base_name = seg_info['module']
-    seg_map = {x['selector']: x for x in seg_info['segments']}
-    fin = args.coverage_log
-    fout = args.out_file
-
-    buf = fin.readline()
-    while (buf):
-        seg, offset = buf.split(':', 1)
-        offset = int( offset.strip(), 16 )
-        if seg in seg_map:
-            if args.human:
-                result = '{}:{:04X} => {}+{}:{:04X}\n'.format( seg, offset, base_name, seg_map[seg]['ida_selector'], offset )
-            else:
-                result = '{}+{:08x}\n'.format( base_name, seg_map[seg]['ida_offset']+offset )
-        elif args.no_filter:
-            result = buf
-        else:
-            buf = fin.readline()
-            continue
+    if args.out_dir and (args.out_file or args.no_filter):
+        parser.error( '--out-dir can\'t be combined with --out-file or --no-filter' )
+    if args.drcov and (args.out_dir or args.no_filter or args.unique or args.counts or args.human):
+        parser.error( '--drcov can\'t be combined with --out-dir, --no-filter, --unique, --counts or --human' )
 
-        if fout:
-            fout.write( result )
-        else:
-            print( result, end='' )
-        buf = fin.readline()
-    if fout:
-        fout.close()
+    # get_segtable.py outputs a list of segment maps when extracting several modules
+    seg_info = []
+    for f in args.segments:
+        data = json.load( f )
+        seg_info.extend( data if isinstance( data, list ) else [data] )
+    if args.out_dir:
+        os.makedirs( args.out_dir, exist_ok=True )
+        fout = {x['module']: open( os.path.join( args.out_dir, '{}.txt'.format( x['module'] ) ), 'wb' ) for x in seg_info}
+    else:
+        fout = args.out_file
 
+    stats = {} if args.stats else None
+    convert_log( args.coverage_log, fout if fout else sys.stdout.buffer, seg_info, human=args.human, no_filter=args.no_filter, unique=args.unique, counts=args.counts, use_numpy=not args.no_numpy, jobs=args.jobs, stats=stats, drcov=args.drcov )
+    if isinstance( fout, dict ):
+        for f in fout.values():
+            f.close()
+    elif fout:
+        fout.close()
+    if stats is not None:
+        with (open( args.stats, 'w' ) if args.stats != '-' else contextlib.nullcontext( sys.stderr )) as f:
+            json.dump( stats, f, indent=4 )
+            f.write( '\n' )
@@ -1,47 +1,411 @@
 #!/usr/bin/env python3
 import argparse
+import bisect
+import contextlib
 import json
+import mmap
 import ntpath
 import math
+import os
+import re
+import socket
+import struct
+import sys
+import time
 
 from mrcrowbar import models as mrc, utils
 from mrcrowbar.lib.hardware import ibm_pc
 from mrcrowbar.lib.os import win16
 
-def get_local_offset( memory_map, offset ):
-    for start, mem in memory_map.items():
-        if offset in range( start, start + len( mem ) ):
-            return start, offset-start
-    raise ValueError
+# the tables in an NE header are all at 16-bit offsets, so the module table
+# never needs more than this much memory
+MAX_MODULE_TABLE_SIZE = 0x10000
 
 
-# dump the local descriptor table
-def get_ldt( memory_map, base, limit ):
-    bank, rel_base = get_local_offset( memory_map, base )
-    return ibm_pc.SegmentDescriptorTable( memory_map[bank][rel_base:][:limit+1] )
+# a module table's OFSTRUCT: cBytes, fFixedDisk, nErrCode, reserved[4], szPathName[128]
+OFSTRUCT_PATH_OFFSET = 0x08
+OFSTRUCT_PATH_SIZE = 0x80
+MODULE_PATH_RE = re.compile( rb'[A-Z]:\\[\x21-\x7e]+$' )
+
+
+# remote regions to map when none are given, matching the MEMDUMPBIN commands in the README
+REMOTE_REGIONS = [(0x00000000, 0x2000000), (0x80000000, 0x1000000)]
+
+# banks are scanned for module tables in blocks of this size, so that
+# remote memory doesn't have to be fetched in one go
+SCAN_BLOCK_SIZE = 0x100000
+
+
+# client for the GDB remote serial protocol, as spoken by GDB stubs in
+# emulators such as DOSBox forks, Bochs and QEMU. only memory reads are needed.
+class GDBRemote( object ):
+    def __init__( self, host, port, timeout=10 ):
+        self.sock = socket.create_connection( (host, port), timeout=timeout )
+        # every reply is acked and followed by the next request, so don't
+        # let Nagle's algorithm hold the small writes back
+        self.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        self.buffer = b''
+        self.max_read = 0x400
+        features = self.packet( b'qSupported' ).split( b';' )
+        for feature in features:
+            if feature.startswith( b'PacketSize=' ):
+                # replies to m are hex-encoded, so each byte takes two characters
+                self.max_read = max( 1, (int( feature[11:], 16 ) - 4) // 2 )
+
+    def close( self ):
+        self.sock.close()
+
+    # wait for a full packet, skipping acks and anything else before it
+    def recv_packet( self ):
+        while True:
+            start = self.buffer.find( b'$' )
+            end = self.buffer.find( b'#', start ) if start != -1 else -1
+            if end != -1 and len( self.buffer ) >= end+3:
+                data, checksum = self.buffer[start+1:end], self.buffer[end+1:end+3]
+                self.buffer = self.buffer[end+3:]
+                return data, int( checksum, 16 )
+            data = self.sock.recv( 0x10000 )
+            if not data:
+                raise OSError( 'GDB remote closed the connection' )
+            self.buffer += data
+
+    # send a packet, and return the payload of the reply
+    def packet( self, data ):
+        checksum = sum( data ) & 0xff
+        self.sock.sendall( b'$' + data + b'#' + '{:02x}'.format( checksum ).encode( 'ascii' ) )
+        while True:
+            reply, checksum = self.recv_packet()
+            if sum( reply ) & 0xff == checksum:
+                self.sock.sendall( b'+' )
+                return self.decode_rle( reply )
+            self.sock.sendall( b'-' )
+
+    # expand run-length encoding: "x*n" repeats x another ord(n)-29 times
+    @staticmethod
+    def decode_rle( data ):
+        if b'*' not in data:
+            return data
+        result = bytearray()
+        i = 0
+        while i < len( data ):
+            if data[i] == ord( '*' ) and result:
+                result.extend( result[-1:]*(data[i+1] - 29) )
+                i += 2
+            else:
+                result.append( data[i] )
+                i += 1
+        return bytes( result )
+
+    def read( self, address, size ):
+        result = bytearray()
+        while len( result ) < size:
+            count = min( self.max_read, size - len( result ) )
+            reply = self.packet( 'm{:x},{:x}'.format( address + len( result ), count ).encode( 'ascii' ) )
+            if not reply or (reply.startswith( b'E' ) and len( reply ) == 3):
+                raise OSError( 'GDB remote could not read 0x{:x} bytes at 0x{:08x}: {}'.format( count, address + len( result ), reply.decode( 'ascii', 'replace' ) ) )
+            result += bytes.fromhex( reply.decode( 'ascii' ) )
+        return bytes( result[:size] )
+
+
+# a bank of memory that is fetched on demand a page at a time, using
+# read( offset, size ). only slicing is supported.
+class PagedMemory( object ):
+    def __init__( self, read, size, page_size=0x1000 ):
+        self.read = read
+        self.size = size
+        self.page_size = page_size
+        self.pages = {}
+
+    def __len__( self ):
+        return self.size
+
+    def __getitem__( self, key ):
+        if not isinstance( key, slice ) or key.step not in (None, 1):
+            raise TypeError( 'PagedMemory only supports contiguous slices' )
+        start, end, _ = key.indices( self.size )
+        if end <= start:
+            return b''
+        first, last = start // self.page_size, (end-1) // self.page_size
+        # fetch each run of missing pages with a single read
+        page = first
+        while page <= last:
+            if page in self.pages:
+                page += 1
+                continue
+            run_end = page
+            while run_end+1 <= last and run_end+1 not in self.pages:
+                run_end += 1
+            offset = page*self.page_size
+            data = self.read( offset, min( (run_end+1)*self.page_size, self.size ) - offset )
+            for i in range( page, run_end+1 ):
+                self.pages[i] = data[(i-page)*self.page_size:][:self.page_size]
+            page = run_end+1
+        data = b''.join( self.pages[i] for i in range( first, last+1 ) )
+        return data[start - first*self.page_size:end - first*self.page_size]
+
+
+# sorted index of memory banks, for looking up addresses across many dumps
+class MemoryMap( object ):
+    def __init__( self, banks=None ):
+        self.starts = []
+        self.banks = []
+        if banks:
+            for start, mem in dict( banks ).items():
+                self.add( start, mem )
+
+    def add( self, start, mem ):
+        index = bisect.bisect_right( self.starts, start )
+        if index > 0 and self.starts[index-1] + len( self.banks[index-1] ) > start:
+            raise ValueError( 'Memory bank at 0x{:08x} overlaps bank at 0x{:08x}'.format( start, self.starts[index-1] ) )
+        if index < len( self.starts ) and start + len( mem ) > self.starts[index]:
+            raise ValueError( 'Memory bank at 0x{:08x} overlaps bank at 0x{:08x}'.format( start, self.starts[index] ) )
+        self.starts.insert( index, start )
+        self.banks.insert( index, mem )
+
+    # memory-map a dump file into the address space, without reading it in
+    def add_file( self, start, path ):
+        with open( path, 'rb' ) as f:
+            if os.fstat( f.fileno() ).st_size == 0:
+                mem = b''
+            else:
+                mem = memoryview( mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) )
+        self.add( start, mem )
+
+    # map a region of a remote machine's memory, fetched on demand
+    def add_remote( self, start, size, remote ):
+        self.add( start, PagedMemory( lambda offset, length: remote.read( start+offset, length ), size ) )
+
+    def items( self ):
+        return zip( self.starts, self.banks )
+
+    def __len__( self ):
+        return len( self.banks )
+
+    def __contains__( self, offset ):
+        index = bisect.bisect_right( self.starts, offset ) - 1
+        return index >= 0 and offset < self.starts[index] + len( self.banks[index] )
+
+    # find the bank containing an address, returns the bank index and relative offset
+    def locate( self, offset ):
+        if offset not in self:
+            raise ValueError( 'Address 0x{:08x} is not in any memory dump'.format( offset ) )
+        index = bisect.bisect_right( self.starts, offset ) - 1
+        return index, offset - self.starts[index]
+
+    # find the start of the run of adjacent banks containing an address
+    def run_start( self, offset ):
+        index, _ = self.locate( offset )
+        while index > 0 and self.starts[index-1] + len( self.banks[index-1] ) == self.starts[index]:
+            index -= 1
+        return self.starts[index]
+
+    # return up to size bytes starting at offset, joining adjacent banks.
+    # stops early at the end of a run of adjacent banks.
+    # views inside a single bank are zero-copy slices.
+    def view( self, offset, size=None ):
+        index, rel_offset = self.locate( offset )
+        parts = []
+        remaining = size
+        while True:
+            mem = self.banks[index]
+            part = mem[rel_offset:] if remaining is None else mem[rel_offset:rel_offset+remaining]
+            parts.append( part )
+            if remaining is not None:
+                remaining -= len( part )
+                if remaining <= 0:
+                    break
+            if index+1 == len( self.banks ) or self.starts[index+1] != self.starts[index] + len( mem ):
+                break
+            index += 1
+            rel_offset = 0
+        return parts[0] if len( parts ) == 1 else b''.join( parts )
 
 
 # scrape a memory dump for an EXE's module table
-# basically, search for the EXE's full path, then check if there's an NE header attached
 def find_module_table( memory_map, app_path ):
-    MAX_LOOKBACK = 0x8000
-    
-    for base, mem in memory_map.items():
-        matches = [x for x in utils.find_all_iter( mem, app_path )]
-        for m in matches:
-            lookback = m-MAX_LOOKBACK
-            ne_matches = [x + lookback for x in utils.find_all_iter( mem, b'NE', start=lookback, end=m ) if ((x + lookback) % 32) == 0]
-            if ne_matches:
-                return base + ne_matches[-1]
-    raise ValueError( 'Could not find a Win16 module table for {}'.format( app_path ) )
+    app_path = app_path.rstrip( b'\x00' )
+    return find_module_tables( memory_map, [app_path] )[app_path]
 
 
-# dump an EXE's module table
+# dump an EXE's module table.
+# only the part up to the entry table is parsed, so that's all that gets read.
 def get_module_table( memory_map, offset ):
-    bank, rel_offset = get_local_offset( memory_map, offset )
-    return win16.ModuleTable( memory_map[bank][rel_offset:] )
+    entry_offset = utils.from_uint16_le( memory_map.view( offset+0x04, 2 ) )
+    return win16.ModuleTable( memory_map.view( offset, min( max( entry_offset, 0x40 ), MAX_MODULE_TABLE_SIZE ) ) )
+
+
+# read the full path that Windows keeps in a module table's OFSTRUCT.
+# returns None if there isn't a plausible DOS path there.
+def get_module_path( memory_map, offset ):
+    try:
+        fileinfo_offset = utils.from_uint16_le( memory_map.view( offset+0x0a, 2 ) )
+        path = bytes( memory_map.view( offset+fileinfo_offset+OFSTRUCT_PATH_OFFSET, OFSTRUCT_PATH_SIZE ) )
+    except (ValueError, struct.error):
+        return None
+    path = path.split( b'\x00', 1 )[0]
+    if not MODULE_PATH_RE.match( path ):
+        return None
+    return path
+
+
+# walk the 32-byte-aligned blocks of a memory bank for the NE signature.
+# instead of searching every byte, this takes a strided view of the first
+# word of each block, so only aligned candidates are ever looked at.
+def scan_ne_signatures( base, mem ):
+    skip = -base % 32
+    for start in range( skip, len( mem ), SCAN_BLOCK_SIZE ):
+        block = mem[start:start+SCAN_BLOCK_SIZE]
+        count = len( block ) // 32
+        words = memoryview( block )[:count*32].cast( 'H' )[::16].tobytes()
+        for match in re.finditer( b'NE', words ):
+            if match.start() % 2 == 0:
+                yield base + start + (match.start() // 2)*32
+
+
+# check that a candidate module table starts with the NE signature, and
+# that its header fields point to tables in the right order
+def check_module_header( memory_map, offset ):
+    header = memory_map.view( offset, 0x40 )
+    if len( header ) < 0x40 or header[:2] != b'NE':
+        return False
+    entry_offset, = struct.unpack_from( '<H', header, 0x04 )
+    fileinfo_offset, = struct.unpack_from( '<H', header, 0x0a )
+    segtable_count, = struct.unpack_from( '<H', header, 0x1c )
+    segtable_offset, restable_offset, resnames_offset, modref_offset, impnames_offset = struct.unpack_from( '<HHHHH', header, 0x22 )
+    return (
+        0x40 <= segtable_offset and
+        segtable_offset + 10*segtable_count <= restable_offset <= resnames_offset <= modref_offset <= impnames_offset <= entry_offset and
+        0x40 <= fileinfo_offset <= MAX_MODULE_TABLE_SIZE - OFSTRUCT_PATH_OFFSET
+    )
+
+
+# scrape a memory dump for every module table in one pass.
+# walks the 32-byte-aligned NE headers and matches against the path stored
+# in each module table, returns a dict of path to offset.
+def find_module_tables( memory_map, app_paths=None ):
+    result = {}
+    for base, mem in memory_map.items():
+        for offset in scan_ne_signatures( base, mem ):
+            if not check_module_header( memory_map, offset ):
+                continue
+            path = get_module_path( memory_map, offset )
+            if path is None or path in result:
+                continue
+            if app_paths is not None and path not in app_paths:
+                continue
+            result[path] = offset
+    if app_paths is not None:
+        missing = [x for x in app_paths if x not in result]
+        if missing:
+            raise ValueError( 'Could not find a Win16 module table for {}'.format( ', '.join( x.decode( 'cp1252' ) for x in missing ) ) )
+        return {x: result[x] for x in app_paths}
+    return result
 
 
+# reads descriptors out of the local descriptor table one at a time, instead
+# of decoding the whole table. each distinct descriptor is only decoded once,
+# and the cache can be seeded with the decoded descriptors from a previous run.
+class LDTReader( object ):
+    def __init__( self, memory_map, base, limit ):
+        self.memory_map = memory_map
+        self.base = base
+        self.limit = limit
+        self.decoded = {}
+
+    def raw( self, index ):
+        if (index+1)*8 > self.limit+1:
+            raise ValueError( 'Selector index 0x{:04x} is past the end of the LDT'.format( index ) )
+        return bytes( self.memory_map.view( self.base+index*8, 8 ) )
+
+    def seed( self, raw, fields ):
+        self.decoded[raw] = fields
+
+    # returns the raw descriptor bytes and a dict of the decoded fields
+    def get( self, index ):
+        raw = self.raw( index )
+        if raw not in self.decoded:
+            ss = ibm_pc.SegmentDescriptor( raw )
+            self.decoded[raw] = {
+                'base': ss.base,
+                'limit': ss.limit,
+                'is_code_segment': bool( ss.code_seg ),
+                'is_present': bool( ss.present ),
+            }
+        return raw, self.decoded[raw]
+
+
+# build the segment map for a module, using the LDT to resolve the selectors
+def get_segment_map( ldt, modtable, module_path, modtable_loc ):
+    seg_list = []
+    ida_offset = 0
+    for i, s in enumerate( modtable.ne_header.segtable ):
+        raw, ss = ldt.get( s.selector >> 3 )
+        seg_list.append( {
+            'index': i,
+            'selector': '{:04x}'.format( s.selector | 7 ).upper(),
+            'base': '0x{:08x}'.format( ss['base'] ),
+            'limit': '0x{:05x}'.format( ss['limit'] ),
+            'is_code_segment': ss['is_code_segment'],
+            'is_present': ss['is_present'],
+            'size': s.size,
+            'alloc_size': s.alloc_size,
+            'ida_selector': '{}seg{:02}'.format( 'c' if ss['is_code_segment'] else 'd', i+1 ),
+            'ida_offset': ida_offset,
+            'descriptor': raw.hex(),
+        } )
+        ida_offset += math.ceil( s.alloc_size/16 )*16
+    return {
+        'module': ntpath.split( module_path )[1],
+        'module_path': module_path,
+        'module_table_offset': '0x{:08x}'.format( modtable_loc ),
+        'segments': seg_list 
+    }
+
+
+# fields compared between snapshots by diff_segment_map
+DIFF_FIELDS = ('selector', 'base', 'limit', 'is_present')
+
+
+# compare a module's segment map against the one from a previous run.
+# returns the segments where any of DIFF_FIELDS changed, with [old, new] values.
+def diff_segment_map( previous, current ):
+    prev_segs = {x['index']: x for x in previous['segments']}
+    changes = []
+    for seg in current['segments']:
+        old = prev_segs.get( seg['index'], {} )
+        changed = {k: [old.get( k ), seg[k]] for k in DIFF_FIELDS if old.get( k ) != seg[k]}
+        if changed:
+            changes.append( {'index': seg['index'], 'selector': seg['selector'], 'changed': changed} )
+    return {
+        'module_table_moved': previous['module_table_offset'] != current['module_table_offset'],
+        'segments': changes,
+    }
+
+
+# seed an LDTReader with the descriptors from a previous run's segment maps
+def seed_ldt( ldt, previous ):
+    for seg_map in previous:
+        for seg in seg_map['segments']:
+            if 'descriptor' in seg:
+                ldt.seed( bytes.fromhex( seg['descriptor'] ), {
+                    'base': int( seg['base'], 16 ),
+                    'limit': int( seg['limit'], 16 ),
+                    'is_code_segment': seg['is_code_segment'],
+                    'is_present': seg['is_present'],
+                } )
+
+
+# reuse module table locations from a previous run, if the table at each
+# offset is still the module table for the same path
+def check_previous_tables( memory_map, previous ):
+    result = {}
+    for seg_map in previous:
+        path = seg_map['module_path'].encode( 'cp1252' )
+        offset = int( seg_map['module_table_offset'], 16 )
+        if offset in memory_map and check_module_header( memory_map, offset ) and get_module_path( memory_map, offset ) == path:
+            result[path] = offset
+    return result
+
 
 DESCRIPTION = 'Extract the Win16 segment table from a DOSBox memory dump.'
 EPILOG = """Windows 3.1 uses a single shared segment table for all programs. In order to use the DOSBox debugger, you will need to know the mapping from 16-bit selectors (as seen in the CS/DS registers) to each segment in the target EXE or DLL. This tool scrapes this mapping from DOSBox memory dumps taken with a running application. In addition, a guess is provided for the segment ID and fake 32-bit offset that IDA Pro would use.
@@ -50,60 +414,136 @@ EPILOG = """Windows 3.1 uses a single shared segment table for all programs. In
 auto_int = lambda s: int( s, base=0 )
 
 
+# parse an address=size remote memory region argument
+def region_arg( s ):
+    address, sep, size = s.partition( '=' )
+    try:
+        if not sep:
+            raise ValueError
+        return auto_int( address ), auto_int( size )
+    except ValueError:
+        raise argparse.ArgumentTypeError( 'Expected address=size, got "{}"'.format( s ) )
+
+
+# parse a host:port argument
+def remote_arg( s ):
+    host, sep, port = s.rpartition( ':' )
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError( 'Expected host:port, got "{}"'.format( s ) )
+    return host or 'localhost', int( port )
+
+
+# parse an address=file memory dump argument
+def dump_arg( s ):
+    address, sep, path = s.partition( '=' )
+    if not sep:
+        raise argparse.ArgumentTypeError( 'Expected address=file, got "{}"'.format( s ) )
+    try:
+        address = auto_int( address )
+    except ValueError:
+        raise argparse.ArgumentTypeError( 'Invalid address "{}"'.format( address ) )
+    return address, path
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser( description=DESCRIPTION, epilog=EPILOG )
     parser.add_argument( 'ldt_base', type=auto_int, help='Base address of the Local Descriptor Table: ("CPU" in the DOSBox debugger -> LDT base)' )
     parser.add_argument( '--ldt_limit', type=auto_int, help='Limit of the Local Descriptor Table: ("CPU" in the DOSBox debugger -> LDT limit)', default=0x2fff, required=False )
-    parser.add_argument( 'module_path', help='Full DOSBox path to the EXE or DLL (e.g. "C:\\\\WINDOWS\\\\PROGMAN.EXE")' )
-    parser.add_argument( 'mem_low', type=argparse.FileType( mode='rb' ), help='Memory dump of the low range: "MEMDUMPBIN 0000 00000000 2000000"' )
-    parser.add_argument( 'mem_high', type=argparse.FileType( mode='rb' ), help='Memory dump of the high range: "MEMDUMPBIN 0000 80000000 1000000"' )
+    parser.add_argument( 'module_path', help='Full DOSBox path to the EXE or DLL (e.g. "C:\\\\WINDOWS\\\\PROGMAN.EXE"). Separate several paths with commas, or use "*" for every loaded module; the output is then a list of segment maps' )
+    parser.add_argument( 'dumps', type=dump_arg, nargs='*', help='Memory dumps as address=file pairs, e.g. "0x0=memory_low.bin" for "MEMDUMPBIN 0000 00000000 2000000" and "0x80000000=memory_high.bin" for "MEMDUMPBIN 0000 80000000 1000000"' )
+    parser.add_argument( '--remote', type=remote_arg, help='Read memory on demand from a running emulator over the GDB remote protocol (host:port), instead of from dumps', required=False )
+    parser.add_argument( '--remote_region', type=region_arg, action='append', help='Region of memory to read over --remote, as address=size. Can be given more than once (default: 0x0=0x2000000 and 0x80000000=0x1000000)', required=False )
+    parser.add_argument( '--previous', type=argparse.FileType( mode='r' ), help='JSON output from a previous run on an earlier snapshot. Module tables and LDT entries that haven\'t changed are reused, and a list of changes to each segment is added to the output', required=False )
     parser.add_argument( '--out_file', type=argparse.FileType( mode='w' ), help='Output JSON file for segment information (default: stdout)', required=False )
+    parser.add_argument( '--stats', metavar='STATS_FILE', help='Write timings and counters for the run to this JSON file ("-" for stderr)', required=False )
     args = parser.parse_args()
+    start = time.perf_counter()
+    timings = {'module_table_scan': 0.0, 'module_table_parse': 0.0, 'ldt_decode': 0.0}
 
-    module_path = args.module_path.upper()
-    module_path_raw = module_path.encode( 'cp1252' )+b'\x00'
-    memory_map = {
-        0x00000000: args.mem_low.read(),
-        0x80000000: args.mem_high.read()
-    }
+    if not args.dumps and not args.remote:
+        parser.error( 'either memory dumps or --remote must be given' )
+
+    memory_map = MemoryMap()
+    for address, path in args.dumps:
+        memory_map.add_file( address, path )
+    if args.remote:
+        remote = GDBRemote( *args.remote )
+        for address, size in args.remote_region or REMOTE_REGIONS:
+            memory_map.add_remote( address, size, remote )
+
+    previous = []
+    if args.previous:
+        previous = json.load( args.previous )
+        if isinstance( previous, dict ):
+            previous = [previous]
 
     # fish out the local descriptor table from the memory dump.
     # this is used by the x86 chip to map segment selectors to memory in protected mode.
-    ldt_dir = get_ldt( memory_map, args.ldt_base, args.ldt_limit )
+    # only the descriptors for the module's segments are read, and any that
+    # are unchanged since the previous run don't need decoding again.
+    ldt = LDTReader( memory_map, args.ldt_base, args.ldt_limit )
+    seed_ldt( ldt, previous )
+    seeded = len( ldt.decoded )
 
     # fish out the Win16 program's module table from the memory dump.
     # every Win16 app has one of these, which is very similar to the NE header
     # in the executable EXCEPT the segment table in this will tell us what
     # segments in the EXE are mapped to what LDT entry.
-    modtable_loc = find_module_table( memory_map, module_path_raw )
-    modtable = get_module_table( memory_map, modtable_loc )
+    scan_start = time.perf_counter()
+    if args.module_path == '*':
+        modtable_locs = find_module_tables( memory_map )
+    else:
+        module_paths = [x.upper().encode( 'cp1252' ) for x in args.module_path.split( ',' )]
+        known = check_previous_tables( memory_map, previous )
+        missing = [x for x in module_paths if x not in known]
+        if missing:
+            known.update( find_module_tables( memory_map, missing ) )
+        modtable_locs = {x: known[x] for x in module_paths}
+    timings['module_table_scan'] = time.perf_counter()-scan_start
 
-    #seg_map = {}
-    seg_list = []
-    ida_offset = 0
-    for i, s in enumerate( modtable.ne_header.segtable ):
-        ss = ldt_dir.seglist[s.selector >> 3]
-        seg_list.append( {
-            'index': i,
-            'selector': '{:04x}'.format( s.selector | 7 ).upper(),
-            'base': '0x{:08x}'.format( ss.base ),
-            'limit': '0x{:05x}'.format( ss.limit ),
-            'is_code_segment': bool( ldt_dir.seglist[s.selector >> 3].code_seg ),
-            'is_present': bool( ldt_dir.seglist[s.selector >> 3].present ),
-            'size': s.size,
-            'alloc_size': s.alloc_size,
-            'ida_selector': '{}seg{:02}'.format( 'c' if ss.code_seg else 'd', i+1 ),
-            'ida_offset': ida_offset
-        } )
-        ida_offset += math.ceil( s.alloc_size/16 )*16
-    result = {
-        'module': ntpath.split( module_path )[1],
-        'module_path': module_path,
-        'module_table_offset': '0x{:08x}'.format( modtable_loc ),
-        'segments': seg_list 
-    }
+    previous_maps = {x['module_path']: x for x in previous}
+    results = []
+    for module_path, modtable_loc in modtable_locs.items():
+        parse_start = time.perf_counter()
+        modtable = get_module_table( memory_map, modtable_loc )
+        decode_start = time.perf_counter()
+        seg_map = get_segment_map( ldt, modtable, module_path.decode( 'cp1252' ), modtable_loc )
+        timings['module_table_parse'] += decode_start-parse_start
+        timings['ldt_decode'] += time.perf_counter()-decode_start
+        if seg_map['module_path'] in previous_maps:
+            seg_map['changes'] = diff_segment_map( previous_maps[seg_map['module_path']], seg_map )
+        results.append( seg_map )
+    result = results[0] if len( results ) == 1 and args.module_path != '*' else results
+    if args.remote:
+        remote.close()
 
     if args.out_file:
         json.dump( result, args.out_file, indent=4 )
     else:
         print( json.dumps( result, indent=4 ) )
+
+    if args.stats:
+        elapsed = time.perf_counter()-start
+        # remote banks only count the pages that were actually fetched
+        remote_bytes = sum( len( mem.pages )*mem.page_size for _, mem in memory_map.items() if isinstance( mem, PagedMemory ) )
+        memory_bytes = sum( len( mem ) for _, mem in memory_map.items() )
+        segments = sum( len( x['segments'] ) for x in results )
+        stats = {
+            'tool': 'get_segtable',
+            'elapsed': round( elapsed, 6 ),
+            'timings': {k: round( v, 6 ) for k, v in timings.items()},
+            'counters': {
+                'memory_bytes': memory_bytes,
+                'remote_bytes': remote_bytes,
+                'modules': len( results ),
+                'segments': segments,
+                'descriptors_decoded': len( ldt.decoded )-seeded,
+                'descriptors_seeded': seeded,
+            },
+            'rates': {
+                'segments_per_s': round( segments/timings['ldt_decode'], 1 ) if timings['ldt_decode'] else None,
+            },
+        }
+        with (open( args.stats, 'w' ) if args.stats != '-' else contextlib.nullcontext( sys.stderr )) as f:
+            json.dump( stats, f, indent=4 )
+            f.write( '\n' )
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+from get_segtable import MemoryMap, dump_arg, auto_int
+
+
+# characters that can't be used as a run length in a reply; a run count of
+# n is sent as chr( n+29 ), and 6 and 7 would come out as '#' and '$'
+RLE_RESERVED = (6, 7)
+# longest run that fits in a printable character
+RLE_MAX_RUN = 126-29
+
+
+# run-length encode a reply payload the way GDB stubs do: "x*n" repeats x
+# another ord(n)-29 times
+def encode_rle( data ):
+    result = bytearray()
+    i = 0
+    while i < len( data ):
+        run = 0
+        while i+run+1 < len( data ) and data[i+run+1] == data[i] and run < RLE_MAX_RUN:
+            run += 1
+        while run in RLE_RESERVED:
+            run -= 1
+        result.append( data[i] )
+        if run >= 3:
+            result += b'*' + bytes( [run+29] )
+            i += run+1
+        else:
+            i += 1
+    return bytes( result )
+
+
+def frame( data ):
+    return b'$' + data + b'#' + '{:02x}'.format( sum( data ) & 0xff ).encode( 'ascii' )
+
+
+# minimal GDB remote protocol stub serving memory from dump files, for testing
+# get_segtable.py --remote without an emulator. it answers qSupported and
+# m (read memory), acks every packet, run-length encodes replies, and can send
+# a bad checksum on every nth reply to make the client ask for a retransmit.
+class MockGDBStub( object ):
+    def __init__( self, memory_map, packet_size=0x1000, corrupt_every=0 ):
+        self.memory_map = memory_map
+        self.packet_size = packet_size
+        self.corrupt_every = corrupt_every
+        self.counters = {'packets': 0, 'bytes': 0, 'retransmits': 0, 'rle_bytes_saved': 0}
+
+    def read( self, address, size ):
+        if address not in self.memory_map:
+            return None
+        return bytes( self.memory_map.view( address, size ) )
+
+    def reply( self, packet ):
+        if packet.startswith( b'qSupported' ):
+            return 'PacketSize={:x}'.format( self.packet_size ).encode( 'ascii' )
+        elif packet.startswith( b'm' ):
+            address, _, size = packet[1:].partition( b',' )
+            data = self.read( int( address, 16 ), min( int( size, 16 ), (self.packet_size-4)//2 ) )
+            if not data:
+                return b'E01'
+            self.counters['bytes'] += len( data )
+            payload = data.hex().encode( 'ascii' )
+            encoded = encode_rle( payload )
+            self.counters['rle_bytes_saved'] += len( payload )-len( encoded )
+            return encoded
+        # anything else is unsupported, which is an empty reply
+        return b''
+
+    def serve( self, conn ):
+        buffer = b''
+        last = None
+        while True:
+            data = conn.recv( 0x10000 )
+            if not data:
+                return
+            buffer += data
+            while buffer:
+                if buffer[:1] == b'+':
+                    buffer = buffer[1:]
+                elif buffer[:1] == b'-':
+                    # the client didn't like the last reply, send it again
+                    buffer = buffer[1:]
+                    self.counters['retransmits'] += 1
+                    conn.sendall( last )
+                elif buffer[:1] == b'$':
+                    end = buffer.find( b'#' )
+                    if end == -1 or len( buffer ) < end+3:
+                        break
+                    packet, checksum = buffer[1:end], int( buffer[end+1:end+3], 16 )
+                    buffer = buffer[end+3:]
+                    if sum( packet ) & 0xff != checksum:
+                        conn.sendall( b'-' )
+                        continue
+                    self.counters['packets'] += 1
+                    last = frame( self.reply( packet ) )
+                    sent = last
+                    if self.corrupt_every and self.counters['packets'] % self.corrupt_every == 0:
+                        sent = last[:-2] + '{:02x}'.format( int( last[-2:], 16 ) ^ 0xff ).encode( 'ascii' )
+                    conn.sendall( b'+' + sent )
+                else:
+                    buffer = buffer[1:]
+
+    # accept connections one at a time until the socket is closed
+    def serve_forever( self, sock ):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            with conn:
+                conn.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+                self.serve( conn )
+
+
+def listen( host, port ):
+    sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    sock.bind( (host, port) )
+    sock.listen()
+    return sock
+
+
+# run get_segtable.py on the dumps directly and over --remote against the stub,
+# and compare the JSON from both
+def check( stub, dumps, ldt_base, ldt_limit, module_path ):
+    sock = listen( '127.0.0.1', 0 )
+    threading.Thread( target=stub.serve_forever, args=(sock,), daemon=True ).start()
+    script = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'get_segtable.py' )
+    command = [sys.executable, script, hex( ldt_base ), module_path]
+    dump_args = ['0x{:x}={}'.format( address, path ) for address, path in dumps]
+    remote_args = ['--remote', '127.0.0.1:{}'.format( sock.getsockname()[1] )]
+    for address, path in dumps:
+        remote_args += ['--remote_region', '0x{:x}=0x{:x}'.format( address, os.path.getsize( path ) )]
+    try:
+        # argparse won't take the dumps after an option, so they go first
+        limit_args = ['--ldt_limit', hex( ldt_limit )]
+        expected = json.loads( subprocess.run( command+dump_args+limit_args, check=True, capture_output=True ).stdout )
+        actual = json.loads( subprocess.run( command+remote_args+limit_args, check=True, capture_output=True ).stdout )
+    except subprocess.CalledProcessError as e:
+        sys.exit( 'get_segtable.py failed:\n{}'.format( e.stderr.decode( 'utf-8', 'replace' ) ) )
+    finally:
+        sock.close()
+    return expected == actual
+
+
+DESCRIPTION = 'Serve memory dumps over the GDB remote protocol, for testing get_segtable.py --remote.'
+EPILOG = """With --check, the stub is started on a free port, get_segtable.py is run once on the dumps and once over --remote, and the exit code is non-zero if the JSON differs. Counters for the session are printed as JSON.
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=DESCRIPTION, epilog=EPILOG )
+    parser.add_argument( 'dumps', type=dump_arg, nargs='+', help='Memory dumps as address=file pairs, as for get_segtable.py' )
+    parser.add_argument( '--port', type=int, default=1234, help='Port to listen on (default: 1234)', required=False )
+    parser.add_argument( '--packet_size', type=auto_int, default=0x1000, help='PacketSize to report in qSupported (default: 0x1000)', required=False )
+    parser.add_argument( '--corrupt_every', type=int, default=0, help='Send a bad checksum on every nth reply, to test retransmits (default: never)', required=False )
+    parser.add_argument( '--check', nargs=2, metavar=('LDT_BASE', 'MODULE_PATH'), help='Compare get_segtable.py output over --remote with the output from the dumps, then exit', required=False )
+    parser.add_argument( '--ldt_limit', type=auto_int, default=0x2fff, help='Limit of the Local Descriptor Table, for --check (default: 0x2fff)', required=False )
+    args = parser.parse_args()
+
+    memory_map = MemoryMap()
+    for address, path in args.dumps:
+        memory_map.add_file( address, path )
+    stub = MockGDBStub( memory_map, packet_size=args.packet_size, corrupt_every=args.corrupt_every )
+
+    if args.check:
+        same = check( stub, args.dumps, auto_int( args.check[0] ), args.ldt_limit, args.check[1] )
+        print( json.dumps( dict( stub.counters, same=same ), indent=4 ) )
+        if not same:
+            sys.exit( 1 )
+    else:
+        sock = listen( '127.0.0.1', args.port )
+        print( 'Listening on 127.0.0.1:{}'.format( args.port ) )
+        try:
+            stub.serve_forever( sock )
+        except KeyboardInterrupt:
+            pass
@@ -1,91 +1,26 @@
 #!/usr/bin/env python3
 import argparse
+import array
+from concurrent.futures import ProcessPoolExecutor
+import collections
+import contextlib
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import weakref
 
 from mrcrowbar import utils
 from mrcrowbar.lib.os import win16
 from mrcrowbar import models as mrc
 
-class Flags:
-    def __init__( self ):
-        self.carry = False
-        self.overflow = False
-        self.zero = False
-        self.sign = False
-    
-    def __repr__( self ):
-        return 'carry={}, overflow={}, zero={}, sign={}'.format( self.carry, self.overflow, self.zero, self.sign )
-     
-
-class Register:
-    def __init__( self, size=2, flags=None ):
-        self.size = size*8
-        self.value = 0
-        self.flags = flags if flags else Flags()
-
-    def _validate( self, value ):
-        assert 0 <= value < (1 << self.size)
-
-    def mov( self, value ):
-        self._validate( value )
-        self.value = value
-
-    def inc( self, value=1 ):
-        self._validate( value )
-        of_test1 = bool(self.value & (1 << (self.size-1)))
-        of_test2 = bool(value & (1 << (self.size-1)))
-        self.value += value
-        self.value %= (1 << self.size)
-        of_test3 = bool(self.value & (1 << (self.size-1)))
-        self.flags.overflow = (of_test1 == of_test2) and (of_test1 != of_test3)
-        self.flags.zero = self.value == 0
-        self.flags.sign = bool(self.value & (1 << (self.size-1)))
-
-    def dec( self, value=1 ):
-        self._validate( value )
-        of_test1 = bool(self.value & (1 << (self.size-1)))
-        of_test2 = not bool(value & (1 << (self.size-1)))
-        self.value -= value
-        self.value %= (1 << self.size)
-        of_test3 = bool(self.value & (1 << (self.size-1)))
-        self.flags.overflow = (of_test1 == of_test2) and (of_test1 != of_test3)
-        self.flags.zero = self.value == 0
-        self.flags.sign = bool(self.value & (1 << (self.size-1)))
-
-    def add( self, value ):
-        self._validate( value )
-        of_test1 = bool(self.value & (1 << (self.size-1)))
-        of_test2 = bool(value & (1 << (self.size-1)))
-        self.value += value
-        self.flags.carry = (self.value < 0) or (self.value >= (1 << self.size))
-        self.value %= (1 << self.size)
-        of_test3 = bool(self.value & (1 << (self.size-1)))
-        self.flags.overflow = (of_test1 == of_test2) and (of_test1 != of_test3)
-        self.flags.zero = self.value == 0
-        self.flags.sign = bool(self.value & (1 << (self.size-1)))
-
-    def sub( self, value ):
-        self._validate( value )
-        of_test1 = bool(self.value & (1 << (self.size-1)))
-        of_test2 = not bool(value & (1 << (self.size-1)))
-        self.value -= value
-        self.flags.carry = (self.value < 0) or (self.value >= (1 << self.size))
-        self.value %= (1 << self.size)
-        of_test3 = bool(self.value & (1 << (self.size-1)))
-        self.flags.overflow = (of_test1 == of_test2) and (of_test1 != of_test3)        
-        self.flags.zero = self.value == 0
-        self.flags.sign = bool(self.value & (1 << (self.size-1)))
-
-def cmp( op1, op2, size=2 ):
-    src = Register( size=size )
-    src.mov( op1 )
-    src.sub( op2 )
-    return src.flags
-    
-
 def optloader_precopy(data, start_offset, precopy_offset, precopy_size):
     si = start_offset 
     di = precopy_offset
-    cx = precopy_size
 
     di += precopy_size - 1
     si += precopy_size - 1
@@ -93,383 +28,742 @@ def optloader_precopy(data, start_offset, precopy_offset, precopy_size):
         data[di] = data[si]
         di -= 1
         si -= 1
-    #print('INITIAL COPY: data[0x{:04x}:0x{:04x}] = data[0x{:04x}:0x{:04x}]'.format(di+1, di+1+cx, si+1, si+1+cx))
-    #utils.hexdump(data)
-
-
-
-def optloader_reverse(src, read_offset, dest, write_offset):
-    global bp, dx, si
-    #utils.hexdump(src)
-    flags = Flags()
-    si = 0
-    di = 0
-    bl = 0
-    bh = 0
-
-    bp = Register(flags=flags)
-    dx = 0x10
-    si = read_offset
-    di = write_offset
-    #print('di=0x{:04x}, si=0x{:04x}'.format(di, si))    
-
-    # sub_31
-    bp.mov( utils.from_uint16_le(src[si:si+2]) )
-    si += 2
-    cx = 0
-    
-    # loc_62
-    while True:
-        #print('==== dx: {:04x}, si: {:04x}, di: {:04x}, bp: {:04x}'.format(dx, si, di, bp.value))
-        # PROBLEM
-        #if di == 0x40b7:
-        #    import pdb; pdb.set_trace()
-
 
-        if (get_bit(src)):
-            # loc_61
-            dest[di] = src[si]
-            #print('di=0x{:04x}, si=0x{:04x}, dest[0x{:04x}] = src[0x{:04x}] = {}'.format(di, si, di, si, src[si:si+1].hex()))
-            di += 1
-            si += 1
-            continue
 
-        # loc_69
-
-        branch1 = 1
-        branch2 = 0
-
-        # loc_6E
-        if (get_bit(src)):
-            # loc_CB
-            cx += 1
-            if (get_bit(src)):
-                cx += 1
-                if (get_bit(src)):
-                    # loc_D9
-                    bh = 0x08
-                    bl = 0x02
-                    if (get_bit(src)):
-                        bh = 0x0C
-                        bl = 0x03
-                        if (get_bit(src)):
-                            cx = src[si]
-                            si += 1
-                            flags = cmp( cx, 0x81 )
-                            if (flags.carry):
-                                pass
-                            elif (not flags.zero):
-                                #print('EXIT CONDITION: src[0x{:04x}] == 0x{:02x}'.format(si-1, cx))
-                                return si
-                            else:
-                                cx = 0
-                                continue
-                        else:
-                            # loc_138
-                            cx = 0
-                            while (bl != 0):
-                                # loc_13A
-                                # loc_13F
-                                cx += cx + get_bit(src)
-                                bl -= 1
-                            # loc_145
-                            cx += bh
-
-                    else:
-                        # loc_138
-                        cx = 0
-                        while (bl != 0):
-                            # loc_13A
-                            # loc_13F
-                            cx += cx + get_bit(src)
-                            bl -= 1
-                        # loc_145
-                        cx += bh
 
+# prefix codes used by the back-reference length and offset fields.
+# each key is the bit string read from the stream, prepended with a 1
+# sentinel bit; each value is (base, number of extra bits to add to base).
+# None marks the escape code, which is followed by a raw length byte.
+# the length codes include the 0 flag bit that marks a back-reference.
+OPTLOADER_LENGTH_CODES = {
+    0b100:      (0x02, 1),
+    0b1010:     (0x04, 1),
+    0b10110:    (0x06, 1),
+    0b101110:   (0x08, 2),
+    0b1011110:  (0x0c, 3),
+    0b1011111:  None,
+}
+
+# high byte of the back-reference offset
+OPTLOADER_OFFSET_CODES = {
+    0b100:      (0x00, 0),
+    0b1010:     (0x01, 0),
+    0b1011:     (0x02, 1),
+    0b1100:     (0x04, 2),
+    0b1101:     (0x08, 3),
+    0b1110:     (0x10, 4),
+    0b11110:    (0x20, 4),
+    0b111110:   (0x30, 4),
+    0b111111:   (0x40, 6),
+}
+
+# longest code plus extra bits in each field
+OPTLOADER_LENGTH_PEEK = 9
+OPTLOADER_OFFSET_PEEK = 11
+
+# masks for the unread bits of a control word, indexed by bits left
+OPTLOADER_BIT_MASKS = [(1 << i)-1 for i in range( 17 )]
+
+
+# expand a prefix code map into a lookup table indexed by the next peek_bits
+# bits of the stream; entries are (bits consumed, value), value is None for
+# the escape code, and invalid bit patterns map to None
+def optloader_code_table( codes, peek_bits ):
+    table = []
+    for peek in range( 1 << peek_bits ):
+        key = 1
+        size = 0
+        while key not in codes and size < peek_bits:
+            size += 1
+            key = (key << 1) | ((peek >> (peek_bits-size)) & 1)
+        if key not in codes:
+            table.append( None )
+            continue
+        leaf = codes[key]
+        if leaf is None:
+            table.append( (size, None) )
+            continue
+        base, extra = leaf
+        value = (peek >> (peek_bits-size-extra)) & ((1 << extra)-1)
+        table.append( (size+extra, base+value) )
+    return table
+
+
+OPTLOADER_LENGTH_TABLE = optloader_code_table( OPTLOADER_LENGTH_CODES, OPTLOADER_LENGTH_PEEK )
+# the decoder wants the distance back from the write pointer, which is
+# (high << 8) + low + 1; fold in everything except the low byte
+OPTLOADER_DISTANCE_TABLE = [(x[0], (x[1] << 8) + 1) if x else None for x in optloader_code_table( OPTLOADER_OFFSET_CODES, OPTLOADER_OFFSET_PEEK )]
+
+
+# decoder for the OPTLOADER bit stream. control bits come in 16-bit LE words,
+# read from the top bit down, with literal bytes in between; the next word
+# is fetched as soon as the last bit of the current one is used, which is
+# where LoadAppSeg expects it
+class OptloaderDecoder:
+    __slots__ = ('src', 'pos', 'word', 'shift')
+
+    def __init__( self, src, pos ):
+        self.src = src
+        self.word = src[pos] | (src[pos+1] << 8)
+        self.pos = pos+2
+        self.shift = 16
+
+    # decompress into dest from write_offset, returns the offset after the end marker.
+    # if stats is a dict, the stream counters are added to it
+    def decode( self, dest, write_offset, stats=None ):
+        # the loop below runs once per literal run or back-reference,
+        # so keep everything in locals
+        src = self.src
+        start = self.pos-2
+        pos = self.pos
+        word = self.word
+        shift = self.shift
+        src_size = len( src )
+        dest_size = len( dest )
+        length_table = OPTLOADER_LENGTH_TABLE
+        distance_table = OPTLOADER_DISTANCE_TABLE
+        LENGTH_PEEK = OPTLOADER_LENGTH_PEEK
+        OFFSET_PEEK = OPTLOADER_OFFSET_PEEK
+        masks = OPTLOADER_BIT_MASKS
+        di = write_offset
+        literals = backrefs = backref_bytes = escapes = 0
+
+        while True:
+            # a run of 1 bits is a run of literal bytes, which are stored
+            # back to back in src. count the run left in this word with
+            # bit_length() and copy it in one go.
+            run = shift - (~word & masks[shift]).bit_length()
+            if run:
+                if di+run > dest_size or pos+run > src_size:
+                    raise IndexError( 'Literal run out of range: di=0x{:04x}, pos=0x{:04x}, length=0x{:x}'.format( di, pos, run ) )
+                literals += run
+                if run < shift:
+                    dest[di:di+run] = src[pos:pos+run]
+                    pos += run
+                    di += run
+                    shift -= run
                 else:
-                    branch2 = 1
+                    # the run empties the word; the next word sits
+                    # between the last two literal bytes
+                    run -= 1
+                    dest[di:di+run] = src[pos:pos+run]
+                    pos += run
+                    di += run
+                    word = src[pos] | (src[pos+1] << 8)
+                    dest[di] = src[pos+2]
+                    pos += 3
+                    di += 1
+                    shift = 16
+                    continue
+
+            # a code never crosses more than one word boundary, and no bytes
+            # are read in the middle of a code, so the following word can be
+            # peeked at without changing the stream position. the fast path
+            # needs at least one bit left over, as the next word has to be
+            # fetched the moment this one runs out.
+            if shift > LENGTH_PEEK:
+                size, length = length_table[(word >> (shift-LENGTH_PEEK)) & 0x1ff]
+                shift -= size
             else:
-                branch2 = 1
-        else:
-            bh = 0
-            branch2 = 1
-
-
-        if branch2:
-            # loc_72
-            cx += 1
-            cx += cx + get_bit(src)
-                
-            if (cx == 2):
-                branch1 = 0
-
-
-        if (branch1):
-            # loc_7F
-            bh = 0
-
-            skip_inc = False
-            if get_bit(src):
-                # loc_FD
-                if get_bit(src):
-                    ch = 0x10
-                    cl = 0x04
-                    if get_bit(src):
-                        ch = 0x20
-                        cl = 0x04
-                        if get_bit(src):
-                            ch = 0x30
-                            cl = 0x04
-                            if get_bit(src):
-                                ch = 0x40
-                                cl = 0x06
+                following = (src[pos] | (src[pos+1] << 8)) if pos+1 < src_size else 0
+                size, length = length_table[((word << (LENGTH_PEEK-shift)) | (following >> (16+shift-LENGTH_PEEK))) & 0x1ff]
+                shift -= size
+                if shift <= 0:
+                    if pos+1 >= src_size:
+                        raise IndexError( 'Bit stream ran past the end of the source' )
+                    word = following
+                    pos += 2
+                    shift += 16
+
+            if length == 2:
+                # 2 byte back-references only get a single byte of offset
+                distance = 1
+            else:
+                if length is None:
+                    length = src[pos]
+                    pos += 1
+                    escapes += 1
+                    if length > 0x81:
+                        self.pos, self.word, self.shift = pos, word, shift
+                        if stats is not None:
+                            optloader_add_stream_stats( stats, pos-start, shift, literals, backrefs, backref_bytes, escapes )
+                        return pos
+                    elif length == 0x81:
+                        continue
+
+                if shift > OFFSET_PEEK:
+                    size, distance = distance_table[(word >> (shift-OFFSET_PEEK)) & 0x7ff]
+                    shift -= size
                 else:
-                    ch = 0x04
-                    cl = 0x02
-                    if get_bit(src):
-                        ch = 0x08
-                        cl = 0x03
+                    following = (src[pos] | (src[pos+1] << 8)) if pos+1 < src_size else 0
+                    size, distance = distance_table[((word << (OFFSET_PEEK-shift)) | (following >> (16+shift-OFFSET_PEEK))) & 0x7ff]
+                    shift -= size
+                    if shift <= 0:
+                        if pos+1 >= src_size:
+                            raise IndexError( 'Bit stream ran past the end of the source' )
+                        word = following
+                        pos += 2
+                        shift += 16
+
+            # the offset wraps around at the 64KB segment boundary
+            si = (di - distance - src[pos]) & 0xffff
+            pos += 1
+            end = di+length
+            if end > dest_size:
+                raise IndexError( 'Back-reference out of range: di=0x{:04x}, si=0x{:04x}, length=0x{:x}'.format( di, si, length ) )
+            if si < di:
+                if di-si < length:
+                    # overlapping copy, repeat the run between si and di
+                    run = dest[si:di]
+                    dest[di:end] = (run * (length // len( run ) + 1))[:length]
+                else:
+                    dest[di:end] = dest[si:si+length]
             else:
-                # loc_87
-                if get_bit(src):
-                    # loc_AE
-                    bh += 1
-                    # loc_B5
-                    if get_bit(src):
-                        ch = 0x02
-                        cl = 0x01
-                    else:
-                        skip_inc = True
-                else: 
-                    skip_inc = True
-
-            if not skip_inc:
-                # loc_BA
-                bh = 0
-
-                # loc_BC
-                while (cl != 0):
-                    bh += bh + get_bit(src)
-                    cl -= 1
-                bh += ch
-
-        # loc_91
-        bl = src[si]
-        si += 1
-        bl ^= 0xff
-        bh ^= 0xff
-        old_di = di
-        old_si = si
-        #import pdb; pdb.set_trace()
-        si = (di+ (bh << 8) + bl) & 0xffff
-        for i in range(cx):
-            dest[di] = dest[si]
-            di += 1
-            si += 1
-        #print('di=0x{:04x}, si=0x{:04x}, dest[0x{:04x}:0x{:04x}] = src[0x{:04x}:0x{:04x}] = {}'.format(old_di, old_si, old_di, old_di+cx, si-cx, si, dest[old_di:old_di+cx].hex()))
-        cx = 0
-        si = old_si
-
-
-def get_bit(src):
-    global bp, dx, si
-    bp.add( bp.value )
-    dx -= 1
-    if (dx == 0):
-        bp.mov( utils.from_uint16_le(src[si:si+2]) )
-        dx = 0x10
-        si += 2
-    res = 1 if bp.flags.carry else 0
-    #print(res)
-    return res
-
+                if si+length > dest_size:
+                    raise IndexError( 'Back-reference out of range: di=0x{:04x}, si=0x{:04x}, length=0x{:x}'.format( di, si, length ) )
+                dest[di:end] = dest[si:si+length]
+            di = end
+            backrefs += 1
+            backref_bytes += length
+
+
+# add the counters for a decoded stream to stats. every byte of the stream
+# that isn't a literal, the low byte of an offset or an escaped length is half
+# of a control word, and shift bits of the last word were left unread
+def optloader_add_stream_stats( stats, size, shift, literals, backrefs, backref_bytes, escapes ):
+    stats['bytes_in'] = stats.get( 'bytes_in', 0 ) + size
+    stats['bits'] = stats.get( 'bits', 0 ) + 8*(size-literals-backrefs-escapes)-shift
+    stats['literals'] = stats.get( 'literals', 0 ) + literals
+    stats['backrefs'] = stats.get( 'backrefs', 0 ) + backrefs
+    stats['backref_bytes'] = stats.get( 'backref_bytes', 0 ) + backref_bytes
+
+
+# the Numba kernel lives in optloader_native.py, which is only imported the
+# first time it's needed; False once we know Numba isn't installed
+optloader_native = None
+
+
+# return the Numba decompression kernel, or None if Numba isn't installed
+def optloader_native_kernel():
+    global optloader_native
+    if optloader_native is None:
+        try:
+            import optloader_native as module
+        except ImportError:
+            module = False
+        optloader_native = module
+    return optloader_native.optloader_reverse_native if optloader_native else None
+
+
+def optloader_reverse(src, read_offset, dest, write_offset, native=True, stats=None):
+    kernel = optloader_native_kernel() if native else None
+    if kernel:
+        counts = [] if stats is not None else None
+        end_offset = kernel( src, read_offset, dest, write_offset, counts )
+        if end_offset < 0:
+            raise IndexError( 'OPTLOADER stream ran out of range: read_offset=0x{:04x}'.format( read_offset ) )
+        if stats is not None:
+            optloader_add_stream_stats( stats, end_offset-read_offset, *counts )
+        return end_offset
+    return OptloaderDecoder( src, read_offset ).decode( dest, write_offset, stats=stats )
+
+
+# decompress a stream into a new buffer of alloc_size, returns (data, offset
+# after the stream); for segments 2 onwards the relocations start there
+def optloader_decompress( src, read_offset, alloc_size, native=True, stats=None ):
+    dest = bytearray( alloc_size )
+    end_offset = optloader_reverse( src, read_offset, dest, 0, native=native, stats=stats )
+    return dest, end_offset
+
+
+# relocation table for a segment, as parallel arrays of the NE record fields.
+# segments can have hundreds of relocations, so win16.Relocation models are
+# only built by to_table() when the EXE is put back together
+class OptloaderRelocations:
+    RECORD_SIZE = 8
+    FIELDS = ('address_types', 'flags', 'offsets', 'indexes', 'values')
 
+    def __init__( self ):
+        self.address_types = array.array( 'B' )
+        self.flags = array.array( 'B' )
+        self.offsets = array.array( 'H' )
+        self.indexes = array.array( 'H' )
+        self.values = array.array( 'H' )
+
+    def __len__( self ):
+        return len( self.offsets )
+
+    def append( self, address_type, flags, offset, index, value ):
+        self.address_types.append( address_type )
+        self.flags.append( flags )
+        self.offsets.append( offset )
+        self.indexes.append( index )
+        self.values.append( value )
+
+    @staticmethod
+    def _le_bytes( values ):
+        if sys.byteorder == 'big':
+            values = array.array( 'H', values )
+            values.byteswap()
+        return values.tobytes()
+
+    # relocations as a NE relocation table
+    def export_data( self ):
+        count = len( self )
+        records = bytearray( count*self.RECORD_SIZE )
+        records[0::8] = self.address_types
+        records[1::8] = self.flags
+        for i, field in enumerate( (self.offsets, self.indexes, self.values) ):
+            data = self._le_bytes( field )
+            records[2+2*i::8] = data[0::2]
+            records[3+2*i::8] = data[1::2]
+        return struct.pack( '<H', count ) + records
+
+    # load from a NE relocation table
+    @classmethod
+    def import_data( cls, data ):
+        result = cls()
+        count = utils.from_uint16_le( data[0:2] )
+        records = data[2:2+count*cls.RECORD_SIZE]
+        result.address_types = array.array( 'B', records[0::8] )
+        result.flags = array.array( 'B', records[1::8] )
+        for i, name in enumerate( ('offsets', 'indexes', 'values') ):
+            data = bytearray( 2*count )
+            data[0::2] = records[2+2*i::8]
+            data[1::2] = records[3+2*i::8]
+            field = array.array( 'H', bytes( data ) )
+            if sys.byteorder == 'big':
+                field.byteswap()
+            setattr( result, name, field )
+        return result
+
+    # build a win16.RelocationTable; parent is the Segment it belongs to
+    def to_table( self, parent=None ):
+        return win16.RelocationTable( source_data=self.export_data(), parent=parent )
+
+
+# OPTLOADER target types, in NE address type and additive flag order
+OPTLOADER_ADDRESS_TYPES = [
+    win16.RelocationAddressType.LOW_BYTE,
+    win16.RelocationAddressType.SELECTOR_16,
+    win16.RelocationAddressType.POINTER_32,
+    win16.RelocationAddressType.OFFSET_16,
+]
+
+
+# parse the OPTLOADER relocation list that follows a segment
 def optloader_get_relocs( raw, relocs_offset, relocs_count ):
     si = relocs_offset
-    #import pdb; pdb.set_trace()
-    def get_selector(al):
-        al -= 1
-        al += ax # base 0, stride 10
-        bx = ax
-        ax <<= 2
-        bx += ax
+    result = OptloaderRelocations()
+    address_types = result.address_types.append
+    flags = result.flags.append
+    offsets = result.offsets.append
+    indexes = result.indexes.append
+    values = result.values.append
 
-    result = win16.RelocationTable()
-    result.reltable = []
-
-
-    #print('relocs_count: {}'.format(relocs_count))
     while relocs_count > 0:
-        #print('START - si: {:04x}'.format(si))
         al = raw[si]
-        ah = raw[si+1]
+        num_items = raw[si+1]
         si += 2
-        num_items = ah
         relocs_count -= num_items
-        #print('relocs_count: {} ({})'.format(relocs_count, -num_items))
         if al == 0xf0:
             # special base type
-            #print('BASE TYPE')
             for i in range( num_items ):
-                al = raw[si]
-                di = utils.from_uint16_le( raw[si+1:si+3] )
-                #print( 'al: {:02x}, di: {:04x}'.format( al, di ) )
+                address_types( win16.RelocationAddressType.SELECTOR_16 )
+                flags( win16.RelocationDetail.INTERNAL_REF )
+                indexes( raw[si] )
+                offsets( raw[si+1] | (raw[si+2] << 8) )
+                values( 0 )
                 si += 3
-                reloc = win16.Relocation( parent=result )
-                reloc.address_type = win16.RelocationAddressType.SELECTOR_16
-                reloc.detail_type = win16.RelocationDetail.INTERNAL_REF
-                reloc.offset = di
-                reloc.detail = win16.RelocationInternalRef( parent=reloc )
-                reloc.detail.index = al
-                result.reltable.append( reloc )
-        else:
-            tgt_type = al & 0x7
-            #print('target type: {:02x}'.format(tgt_type) )
-
-            src_type = (al >> 3) & 0x3
-            #print('source type: {:02x}'.format(src_type) )
-            
-            TGT_TYPES = [
-                win16.RelocationAddressType.LOW_BYTE,
-                win16.RelocationAddressType.SELECTOR_16,
-                win16.RelocationAddressType.POINTER_32,
-                win16.RelocationAddressType.OFFSET_16,
-            ]
-
-            reloc_base = win16.Relocation()
-            reloc_base.address_type = TGT_TYPES[tgt_type & 3]
-            reloc_base.additive = 1 if (tgt_type & 4) else 0
-
-            if src_type == 0x00:
-                #print('RELOC_SRC_INTERNAL')
-                al = raw[si]
-                si += 1
-                #print('seg ID: {}'.format(al))
-                if al != 0xff:
-                    loops = 1
-                else:
-                    loops = num_items
-
-                for i in range( loops ):
-                    di = utils.from_uint16_le( raw[si:si+2] )
-                    dx = utils.from_uint16_le( raw[si+2:si+4] )
-                    si += 4
-                    #print('di: {:04x}, dx: {:04x}'.format(di, dx))
-                    # call the target func
-                    new_reloc = win16.Relocation( reloc_base, parent=result )
-                    new_reloc.detail_type = win16.RelocationDetail.INTERNAL_REF
-                    new_reloc.offset = di
-                    new_reloc.detail = win16.RelocationInternalRef( parent=new_reloc )
-                    new_reloc.detail.index = al
-                    result.reltable.append( new_reloc )
-
-
-            elif src_type == 0x01:
-                #print('RELOC_SRC_ORDINAL')
-                ax = utils.from_uint16_le( raw[si:si+2] )
-                #print('modref ID: {}'.format(ax))
-                si += 2
-                for i in range( num_items ):
-                    di = utils.from_uint16_le( raw[si:si+2] )
-                    dx = utils.from_uint16_le( raw[si+2:si+4] )
-                    si += 4
-                    #print('di: {:04x}, dx: {:04x}'.format(di, dx))
-                    # call the target func
-                    new_reloc = win16.Relocation( reloc_base, parent=result )
-                    new_reloc.detail_type = win16.RelocationDetail.IMPORT_ORDINAL
-                    new_reloc.offset = di
-                    new_reloc.detail = win16.RelocationImportOrdinal( parent=new_reloc )
-                    new_reloc.detail.index = ax
-                    new_reloc.detail.ordinal = dx
-                    result.reltable.append( new_reloc )
-
-
-            elif src_type == 0x02:
-                #print('RELOC_SRC_NAME')
-                ax = utils.from_uint16_le( raw[si:si+2] )
-                #print('modref ID: {}'.format(ax))
-                si += 2
-                for i in range( num_items ):
-                    di = utils.from_uint16_le( raw[si:si+2] )
-                    bx = utils.from_uint16_le( raw[si+2:si+4] )
-                    si += 4
-                    #print('di: {:04x}, dx: {:04x}'.format(di, bx))
-                    # call the target func
-                    new_reloc = win16.Relocation(reloc_base, parent=result )
-                    new_reloc.detail_type = win16.RelocationDetail.IMPORT_NAME
-                    new_reloc.offset = di
-                    new_reloc.detail = win16.RelocationImportName( parent=new_reloc )
-                    new_reloc.detail.index = ax
-                    new_reloc.detail.name_offset = bx
-                    result.reltable.append( new_reloc )
-
-
-            elif src_type == 0x03:
-                #print('RELOC_SRC_OSFLOAT')
-                ax = utils.from_uint16_le( raw[si:si+2] )
+            continue
+
+        tgt_type = al & 0x7
+        src_type = (al >> 3) & 0x3
+        address_type = OPTLOADER_ADDRESS_TYPES[tgt_type & 3]
+        additive = 0x04 if (tgt_type & 4) else 0
+
+        if src_type == 0x00:
+            # RELOC_SRC_INTERNAL: 0xff for movable segments, which have
+            # one target per item, otherwise a fixed segment with only
+            # one target. the target offset isn't recorded.
+            al = raw[si]
+            si += 1
+            loops = 1 if al != 0xff else num_items
+            for i in range( loops ):
+                address_types( address_type )
+                flags( win16.RelocationDetail.INTERNAL_REF | additive )
+                offsets( raw[si] | (raw[si+1] << 8) )
+                indexes( al )
+                values( 0 )
+                si += 4
+
+        elif src_type == 0x03:
+            # RELOC_SRC_OSFLOAT
+            fixup = win16.RelocationOSFixupType( raw[si] | (raw[si+1] << 8) )
+            si += 2
+            for i in range( num_items ):
+                address_types( address_type )
+                flags( win16.RelocationDetail.OS_FIXUP | additive )
+                offsets( raw[si] | (raw[si+1] << 8) )
+                indexes( fixup )
+                values( 0 )
                 si += 2
-                for i in range( num_items ):
-                    di = utils.from_uint16_le( raw[si:si+2] )
-                    si += 2
-                    new_reloc = win16.Relocation(reloc_base, parent=result )
-                    new_reloc.detail_type = win16.RelocationDetail.OS_FIXUP
-                    new_reloc.offset = di
-                    new_reloc.detail = win16.RelocationOSFixup( parent=new_reloc )
-                    new_reloc.detail.fixup = win16.RelocationOSFixupType( ax )
-                    result.reltable.append( new_reloc )
 
-            else:
-                print('unknown src type? {:02x}'.format(src_type))
+        else:
+            # RELOC_SRC_ORDINAL and RELOC_SRC_NAME: module index, then
+            # pairs of offset and ordinal/name offset
+            detail_type = win16.RelocationDetail.IMPORT_ORDINAL if src_type == 0x01 else win16.RelocationDetail.IMPORT_NAME
+            ax = raw[si] | (raw[si+1] << 8)
+            si += 2
+            for i in range( num_items ):
+                address_types( address_type )
+                flags( detail_type | additive )
+                offsets( raw[si] | (raw[si+1] << 8) )
+                indexes( ax )
+                values( raw[si+2] | (raw[si+3] << 8) )
+                si += 4
     return result
 
 
 
-def optloader_unpack( in_file ):
-    if in_file[0:2] != b'MZ':
-        raise ValueError( 'Input file is not a Win16 executable - MZ header missing' )
-    ne_offset = utils.from_uint16_le( in_file[0x3c:0x3e] )
-    if in_file[ne_offset:ne_offset+2] != b'NE':
-        raise ValueError( 'Input file is not a Win16 executable - NE header missing' )
-
-    e = win16.EXE( in_file )
+OPTLOADER_SIGNATURE = b'OPTLOADER - Copyright (C) 1993 SLR Systems\nAll Rights Reserved\x00'
 
-    unpacked = []
 
-    # special treatment for segment 1, which unpacks itself
-    seg1_raw = in_file[e.ne_header.segtable[0].offset:][:e.ne_header.segtable[0].size]
-    if seg1_raw[0x17f:0x1be] != b'OPTLOADER - Copyright (C) 1993 SLR Systems\nAll Rights Reserved\x00':
+# unpack segment 1, the BootApp stub, which decompresses itself in place
+def optloader_unpack_loader( seg1_raw, alloc_size, native=True ):
+    if seg1_raw[0x17f:0x1be] != OPTLOADER_SIGNATURE:
         raise ValueError( 'Input file is not an OPTLOADER compressed executable' )
 
-    seg1 = bytearray( e.ne_header.segtable[0].alloc_size )
+    seg1 = bytearray( alloc_size )
     seg1[:len( seg1_raw )] = seg1_raw
 
     start_offset = utils.from_uint16_le( seg1[0x08:0x0a] )
     precopy_size = utils.from_uint16_le( seg1[0x2e:0x30] )
-    alloc_size = e.ne_header.segtable[0].alloc_size
     optloader_precopy( seg1, start_offset=start_offset, precopy_offset=alloc_size-precopy_size, precopy_size=precopy_size )
-    optloader_reverse( src=seg1, read_offset=alloc_size-precopy_size, dest=seg1, write_offset=start_offset )
+    optloader_reverse( src=seg1, read_offset=alloc_size-precopy_size, dest=seg1, write_offset=start_offset, native=native )
 
     # patch out hints to use insane loader in the header
     #seg1[0x00:0x18] = b'\x00'*0x18
-    unpacked.append( (seg1, []) )
-
-    # now for the rest of the crap
-    for i, seg in enumerate( e.ne_header.segtable[1:] ):
-        # would you believe, the compression in this thing
-        # relies on the random contents of whatever's in the EXE 
-        # between the 512 byte sector boundary and the start of
-        # the segment! utterly cooked
-        predelta = seg.offset & 0x1ff
-        postdelta = 512-((seg.size+predelta) % 512)
-        raw = in_file[seg.offset & 0xfffffe00:][:seg.size+predelta+postdelta]
-        seg_out = bytearray( seg.alloc_size )
-
-        start_offset = predelta
-        relocs_count = utils.from_uint16_le( raw[start_offset:start_offset+2] )
-        start_offset += 2
-        relocs_offset = optloader_reverse( raw, start_offset, seg_out, 0 )
-        relocs = optloader_get_relocs( raw, relocs_offset, relocs_count )
-        unpacked.append( (seg_out, relocs) )
+    return seg1
+
+
+# fetch the compressed window for a segment, returns (raw, offset of segment in raw)
+def optloader_segment_raw( in_file, offset, size ):
+    # would you believe, the compression in this thing
+    # relies on the random contents of whatever's in the EXE 
+    # between the 512 byte sector boundary and the start of
+    # the segment! utterly cooked
+    predelta = offset & 0x1ff
+    postdelta = 512-((size+predelta) % 512)
+    start = offset & 0xfffffe00
+    raw = in_file[start:start+size+predelta+postdelta]
+    return raw, predelta
+
+
+# unpack one of segments 2 onwards, returns (data, OptloaderRelocations)
+def optloader_unpack_segment( raw, start_offset, alloc_size, native=True, stats=None ):
+    relocs_count = utils.from_uint16_le( raw[start_offset:start_offset+2] )
+    seg_out, relocs_offset = optloader_decompress( raw, start_offset+2, alloc_size, native=native, stats=stats )
+    relocs = optloader_get_relocs( raw, relocs_offset, relocs_count )
+    return seg_out, relocs
+
+
+# on-disk cache of unpacked segments, keyed by a hash of the compressed window
+# (sector padding included), so segments shared between builds are only
+# decompressed once. least recently used entries go when it passes max_size
+class OptloaderCache:
+    HEADER = struct.Struct( '<I' )
+
+    def __init__( self, path, max_size=256*1024*1024 ):
+        self.path = path
+        self.max_size = max_size
+        self._total = None
+
+    def key( self, raw, start_offset, alloc_size ):
+        h = hashlib.sha256()
+        h.update( struct.pack( '<HI', start_offset, alloc_size ) )
+        h.update( raw )
+        return h.hexdigest()
+
+    def _entry_path( self, key ):
+        return os.path.join( self.path, key+'.seg' )
+
+    # (data, OptloaderRelocations) if cached, else None
+    def get( self, raw, start_offset, alloc_size ):
+        return self.load( self.key( raw, start_offset, alloc_size ) )
+
+    def has( self, key ):
+        return os.path.exists( self._entry_path( key ) )
+
+    def load( self, key ):
+        path = self._entry_path( key )
+        try:
+            with open( path, 'rb' ) as f:
+                entry = f.read()
+            # bump the modification time, which is used for LRU eviction
+            os.utime( path )
+        except FileNotFoundError:
+            return None
+        data_size, = self.HEADER.unpack_from( entry )
+        data_end = self.HEADER.size+data_size
+        data = bytearray( entry[self.HEADER.size:data_end] )
+        relocs = OptloaderRelocations.import_data( entry[data_end:] )
+        return data, relocs
+
+    def put( self, raw, start_offset, alloc_size, data, relocs ):
+        self.store( self.key( raw, start_offset, alloc_size ), data, relocs )
+
+    def store( self, key, data, relocs ):
+        os.makedirs( self.path, exist_ok=True )
+        path = self._entry_path( key )
+        entry = self.HEADER.pack( len( data ) ) + bytes( data ) + relocs.export_data()
+        # other processes may be reading the cache
+        temp_path = '{}.{}.tmp'.format( path, os.getpid() )
+        with open( temp_path, 'wb' ) as f:
+            f.write( entry )
+        os.replace( temp_path, path )
+        if self._total is None:
+            self._total = self.size()
+        else:
+            self._total += len( entry )
+        if self._total > self.max_size:
+            self.evict()
+
+    def _entries( self ):
+        result = []
+        for name in os.listdir( self.path ):
+            if not name.endswith( '.seg' ):
+                continue
+            try:
+                stat = os.stat( os.path.join( self.path, name ) )
+            except FileNotFoundError:
+                continue
+            result.append( (stat.st_mtime, stat.st_size, name) )
+        return result
+
+    def size( self ):
+        if not os.path.isdir( self.path ):
+            return 0
+        return sum( x[1] for x in self._entries() )
+
+    def evict( self ):
+        entries = sorted( self._entries() )
+        total = sum( x[1] for x in entries )
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove( os.path.join( self.path, name ) )
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total = total
+
+
+# unpack a list of (raw, start_offset, alloc_size) over jobs worker processes,
+# yielding (data, OptloaderRelocations) in order as soon as each is ready
+# segments are sent to worker processes in batches of at least this many bytes
+# of compressed window; there are often hundreds of tiny ones, and the
+# per-task overhead would otherwise eat the gains
+OPTLOADER_BATCH_SIZE = 0x10000
+
+
+# returns the unpacked segments, and the stream counters for all of them if
+# stats is set
+def optloader_unpack_batch( batch, native=True, stats=False ):
+    counters = {} if stats else None
+    return [optloader_unpack_segment( *w, native=native, stats=counters ) for w in batch], counters
+
+
+# unpack segments over a process pool, yielding them in order. only a few
+# batches per worker are in flight at once, and memoryviews can't be pickled,
+# so each window is copied just before its batch is submitted
+def optloader_unpack_parallel( pool, work, jobs, native=True, stats=None ):
+    def results( future ):
+        unpacked, counters = future.result()
+        if stats is not None:
+            for key, value in counters.items():
+                stats[key] = stats.get( key, 0 ) + value
+        return unpacked
+
+    pending = collections.deque()
+    batch = []
+    batch_size = 0
+    for i, (raw, start_offset, alloc_size) in enumerate( work ):
+        batch.append( (bytes( raw ), start_offset, alloc_size) )
+        batch_size += len( raw )
+        if batch_size < OPTLOADER_BATCH_SIZE and i < len( work )-1:
+            continue
+        pending.append( pool.submit( optloader_unpack_batch, batch, native, stats is not None ) )
+        batch = []
+        batch_size = 0
+        if len( pending ) >= jobs*2:
+            yield from results( pending.popleft() )
+    while pending:
+        yield from results( pending.popleft() )
+
+
+# if stats is a dict, the stream counters for every segment are added to it
+def optloader_iter_segments( work, jobs=1, cache=None, native=True, stats=None ):
+    # only check which segments are cached here; entries are loaded as
+    # they're yielded, so a warm cache doesn't hold the whole image
+    keys = [cache.key( *w ) for w in work] if cache else [None]*len( work )
+    hits = [cache.has( k ) for k in keys] if cache else [False]*len( work )
+    misses = [w for w, hit in zip( work, hits ) if not hit]
+    parallel = jobs > 1 and len( misses ) > 1
+
+    with (ProcessPoolExecutor( max_workers=jobs ) if parallel else contextlib.nullcontext()) as pool:
+        if parallel:
+            unpacked = optloader_unpack_parallel( pool, misses, jobs, native=native, stats=stats )
+        else:
+            unpacked = (optloader_unpack_segment( *w, native=native, stats=stats ) for w in misses)
+
+        for (raw, start_offset, alloc_size), key, hit in zip( work, keys, hits ):
+            x = cache.load( key ) if hit else None
+            if x is None:
+                # entries can be evicted by another process in the meantime
+                x = optloader_unpack_segment( raw, start_offset, alloc_size, native=native, stats=stats ) if hit else next( unpacked )
+                if cache:
+                    cache.store( key, *x )
+            elif stats is not None:
+                # the cache only has the output, so the stream still has to be
+                # decoded to count what's in it
+                optloader_decompress( raw, start_offset+2, alloc_size, native=native, stats=stats )
+            yield x
+
+
+def optloader_unpack_segments( work, jobs=1, cache=None, native=True, stats=None ):
+    return list( optloader_iter_segments( work, jobs=jobs, cache=cache, native=native, stats=stats ) )
+
+
+# read-only memory map of a file; empty files can't be mapped, so give b'' for those
+@contextlib.contextmanager
+def optloader_map_file( path ):
+    with open( path, 'rb' ) as f:
+        if os.fstat( f.fileno() ).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+            yield mm
+
+
+# NE header fields used by the unpacker
+NE_FLAGS = 0x0c
+NE_SEGTABLE_COUNT = 0x1c
+NE_NONRESNAMES_SIZE = 0x20
+NE_SEGTABLE_OFFSET = 0x22
+NE_RESTABLE_OFFSET = 0x24
+NE_RESNAMES_OFFSET = 0x26
+NE_NONRESNAMES_OFFSET = 0x2c
+NE_SECTOR_SHIFT = 0x32
+NE_FLAG_SELF_LOADING = 0x0800
+
+# segment table entry: offset in sectors, size, flags, allocation size
+NE_SEGMENT = struct.Struct( '<HHHH' )
+NE_SEGMENT_ITERATED = 0x0008
+NE_SEGMENT_RELOCATIONS = 0x0100
+
+
+# read the parts of the NE header the unpacker needs, including the segment
+# table as (file offset, size, flags, allocation size)
+def optloader_read_header( in_file ):
+    if in_file[0:2] != b'MZ':
+        raise ValueError( 'Input file is not a Win16 executable - MZ header missing' )
+    ne_offset = utils.from_uint16_le( in_file[0x3c:0x3e] )
+    if in_file[ne_offset:ne_offset+2] != b'NE':
+        raise ValueError( 'Input file is not a Win16 executable - NE header missing' )
+
+    def field( offset ):
+        return utils.from_uint16_le( in_file[ne_offset+offset:ne_offset+offset+2] )
+
+    sector_shift = field( NE_SECTOR_SHIFT )
+    segtable_offset = ne_offset+field( NE_SEGTABLE_OFFSET )
+    segments = []
+    for i in range( field( NE_SEGTABLE_COUNT ) ):
+        offset_sect, size, flags, alloc_size = NE_SEGMENT.unpack_from( in_file, segtable_offset+i*NE_SEGMENT.size )
+        segments.append( (offset_sect << sector_shift, size, flags, alloc_size) )
+    return {'ne_offset': ne_offset, 'sector_shift': sector_shift, 'segments': segments}
+
+
+# lazily unpacked OPTLOADER executable. the NE header and segment 1 are read up
+# front, other segments are decompressed the first time they're asked for.
+# close it (or use it as a context manager) before closing an mmap in_file
+class OptloaderImage:
+    def __init__( self, in_file, cache=None, native=True ):
+        self.in_file = in_file
+        self.cache = cache
+        self.native = native
+        self.header = optloader_read_header( in_file )
+        # slicing a memoryview doesn't copy, so the compressed windows
+        # for each segment can be handed around without duplicating the file
+        self._view = memoryview( in_file )
+        self._segments = {}
+        # unfinished segments() generators hold views of in_file, and
+        # have to be closed before it can be
+        self._generators = weakref.WeakSet()
+
+        # special treatment for segment 1, which unpacks itself
+        offset, size, _, alloc_size = self.header['segments'][0]
+        self._segments[1] = (optloader_unpack_loader( self._view[offset:offset+size], alloc_size, native=native ), None)
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.close()
+
+    @classmethod
+    @contextlib.contextmanager
+    def open( cls, path, cache=None, native=True ):
+        with optloader_map_file( path ) as in_file:
+            with cls( in_file, cache=cache, native=native ) as image:
+                yield image
+
+    def close( self ):
+        for generator in list( self._generators ):
+            generator.close()
+        self._view = None
+        self.in_file = None
+
+    def __len__( self ):
+        return len( self.header['segments'] )
+
+    def _work( self, n ):
+        offset, size, flags, alloc_size = self.header['segments'][n-1]
+        raw, start_offset = optloader_segment_raw( self._view, offset, size )
+        return raw, start_offset, alloc_size
+
+    # (data, relocations) for segment n, numbered from 1 as in the NE segment
+    # table; segment 1 is the loader and has no relocations
+    def segment( self, n ):
+        if not 1 <= n <= len( self ):
+            raise IndexError( 'Segment {} out of range (1-{})'.format( n, len( self ) ) )
+        if n not in self._segments:
+            self._segments[n] = next( optloader_iter_segments( [self._work( n )], cache=self.cache, native=self.native ) )
+        return self._segments[n]
+
+    # yield every segment in order; ones not unpacked yet aren't kept, so streaming
+    # a file doesn't hold it all in memory. if stats is a dict, the stream
+    # counters for the segments unpacked along the way are added to it
+    def segments( self, jobs=1, stats=None ):
+        generator = self._iter_segments( jobs, stats )
+        self._generators.add( generator )
+        return generator
+
+    def _iter_segments( self, jobs, stats ):
+        missing = [n for n in range( 2, len( self )+1 ) if n not in self._segments]
+        unpacked = optloader_iter_segments( [self._work( n ) for n in missing], jobs=jobs, cache=self.cache, native=self.native, stats=stats )
+        missing = set( missing )
+        for n in range( 1, len( self )+1 ):
+            yield next( unpacked ) if n in missing else self._segments[n]
+
+
+# unpack into a win16.EXE model; optloader_write is much faster for writing a file
+def optloader_unpack( in_file, jobs=1, cache=None, native=True ):
+    with OptloaderImage( in_file, cache=cache, native=native ) as image:
+        unpacked = list( image.segments( jobs=jobs ) )
+    e = win16.EXE( in_file )
 
     # load segments back into exe
     e.ne_header.flags &= 0xf7ff
@@ -478,20 +772,296 @@ def optloader_unpack( in_file ):
         e.ne_header.segtable[i].iterated = 0
         if x[1]:
             e.ne_header.segtable[i].relocations = 1
-            e.ne_header.segtable[i].segment.relocations = x[1]
+            e.ne_header.segtable[i].segment.relocations = x[1].to_table( parent=e.ne_header.segtable[i].segment )
     e.segdatastore.save()
 
     return e
 
 
+# resources in the NE resource table as (entry offset, file offset, size, align shift)
+def optloader_resources( in_file, ne_offset ):
+    restable_offset = ne_offset+utils.from_uint16_le( in_file[ne_offset+NE_RESTABLE_OFFSET:ne_offset+NE_RESTABLE_OFFSET+2] )
+    resnames_offset = ne_offset+utils.from_uint16_le( in_file[ne_offset+NE_RESNAMES_OFFSET:ne_offset+NE_RESNAMES_OFFSET+2] )
+    if restable_offset >= resnames_offset:
+        return []
+    align_shift = utils.from_uint16_le( in_file[restable_offset:restable_offset+2] )
+    result = []
+    pointer = restable_offset+2
+    # each resource type has a type ID, count and 4 reserved bytes, then
+    # 12 bytes for each resource, starting with its offset and size
+    while pointer+2 <= resnames_offset:
+        type_id, count = struct.unpack_from( '<HH', in_file, pointer )
+        if type_id == 0:
+            break
+        pointer += 8
+        for i in range( count ):
+            offset, size = struct.unpack_from( '<HH', in_file, pointer )
+            result.append( (pointer, offset << align_shift, size << align_shift, align_shift) )
+            pointer += 12
+    return result
+
+
+# write an unpacked executable straight to fout, without a win16.EXE model.
+# the stub and NE tables are copied, then the segments (None for relocations
+# keeps the original table), any trailing resources and names, and finally the
+# header and segment table are rewritten. returns the number of relocations
+def optloader_write( in_file, header, segments, fout ):
+    ne_offset = header['ne_offset']
+    align = 1 << header['sector_shift']
+    resources = optloader_resources( in_file, ne_offset )
+    data_offsets = [x[0] for x in header['segments'] if x[0]]+[x[1] for x in resources if x[1]]
+    header_end = min( data_offsets ) if data_offsets else len( in_file )
+    out_header = bytearray( in_file[:header_end] )
+
+    def pad( position, align ):
+        fill = -position % align
+        fout.write( bytes( fill ) )
+        return position+fill
+
+    start = fout.tell()
+    fout.write( out_header )
+    position = pad( header_end, align )
+
+    segtable_offset = ne_offset+utils.from_uint16_le( in_file[ne_offset+NE_SEGTABLE_OFFSET:ne_offset+NE_SEGTABLE_OFFSET+2] )
+    total_relocs = 0
+    for i, ((offset, size, flags, alloc_size), (data, relocs)) in enumerate( zip( header['segments'], segments ) ):
+        flags &= ~NE_SEGMENT_ITERATED
+        # segments without fixups keep the relocations flag they had
+        if relocs:
+            flags |= NE_SEGMENT_RELOCATIONS
+        if relocs is not None and flags & NE_SEGMENT_RELOCATIONS:
+            reloc_data = relocs.export_data()
+            total_relocs += len( relocs )
+        elif flags & NE_SEGMENT_RELOCATIONS:
+            count = utils.from_uint16_le( in_file[offset+size:offset+size+2] )
+            reloc_data = in_file[offset+size:offset+size+2+count*OptloaderRelocations.RECORD_SIZE]
+        else:
+            reloc_data = b''
+        NE_SEGMENT.pack_into( out_header, segtable_offset+i*NE_SEGMENT.size, position // align, len( data ) & 0xffff, flags, alloc_size )
+        fout.write( data )
+        fout.write( reloc_data )
+        position = pad( position+len( data )+len( reloc_data ), align )
+
+    for entry, offset, size, align_shift in resources:
+        if not offset:
+            continue
+        position = pad( position, 1 << align_shift )
+        struct.pack_into( '<H', out_header, entry, position >> align_shift )
+        fout.write( in_file[offset:offset+size] )
+        position += size
+
+    nonres_offset = utils.from_uint32_le( in_file[ne_offset+NE_NONRESNAMES_OFFSET:ne_offset+NE_NONRESNAMES_OFFSET+4] )
+    if nonres_offset and nonres_offset >= header_end:
+        nonres_size = utils.from_uint16_le( in_file[ne_offset+NE_NONRESNAMES_SIZE:ne_offset+NE_NONRESNAMES_SIZE+2] )
+        struct.pack_into( '<I', out_header, ne_offset+NE_NONRESNAMES_OFFSET, position )
+        fout.write( in_file[nonres_offset:nonres_offset+nonres_size] )
+
+    flags = utils.from_uint16_le( out_header[ne_offset+NE_FLAGS:ne_offset+NE_FLAGS+2] )
+    struct.pack_into( '<H', out_header, ne_offset+NE_FLAGS, flags & ~NE_FLAG_SELF_LOADING )
+    end = fout.tell()
+    fout.seek( start )
+    fout.write( out_header )
+    fout.seek( end )
+    return total_relocs
+
+
+# cheap check for an OPTLOADER executable, reads only the headers and first segment entry
+def optloader_detect( in_file ):
+    if len( in_file ) < 0x40 or in_file[0:2] != b'MZ':
+        return False
+    ne_offset = utils.from_uint16_le( in_file[0x3c:0x3e] )
+    if len( in_file ) < ne_offset+0x40 or in_file[ne_offset:ne_offset+2] != b'NE':
+        return False
+    segtable_offset = ne_offset+utils.from_uint16_le( in_file[ne_offset+0x22:ne_offset+0x24] )
+    sector_shift = utils.from_uint16_le( in_file[ne_offset+0x32:ne_offset+0x34] )
+    if len( in_file ) < segtable_offset+8:
+        return False
+    seg1_offset = utils.from_uint16_le( in_file[segtable_offset:segtable_offset+2] ) << sector_shift
+    return in_file[seg1_offset+0x17f:seg1_offset+0x1be] == OPTLOADER_SIGNATURE
+
+
+def optloader_new_stats():
+    return {
+        'tool': 'optloader',
+        'elapsed': 0.0,
+        'timings': {'open': 0.0, 'unpack': 0.0, 'write': 0.0},
+        'counters': {
+            'files': 0, 'segments': 0, 'bytes_in': 0, 'bytes_out': 0, 'bits': 0,
+            'literals': 0, 'backrefs': 0, 'backref_bytes': 0, 'relocations': 0, 'additive_relocations': 0,
+            'relocations_by_type': collections.Counter(),
+            'relocations_by_address_type': collections.Counter(),
+        },
+    }
+
+
+# pass segments through, adding unpack time and relocation counts to report
+def optloader_count_segments( segments, report ):
+    timings = report['timings']
+    counters = report['counters']
+    segments = iter( segments )
+    while True:
+        start = time.perf_counter()
+        segment = next( segments, None )
+        timings['unpack'] += time.perf_counter()-start
+        if segment is None:
+            return
+        data, relocs = segment
+        # segment 1 is unpacked up front, and has no relocations
+        if relocs is not None:
+            counters['bytes_out'] += len( data )
+            counters['relocations'] += len( relocs )
+            by_type = counters['relocations_by_type']
+            for flags, count in collections.Counter( relocs.flags ).items():
+                by_type[win16.RelocationDetail( flags & 3 ).name] += count
+                if flags & 0x04:
+                    counters['additive_relocations'] += count
+            by_address_type = counters['relocations_by_address_type']
+            for address_type, count in collections.Counter( relocs.address_types ).items():
+                by_address_type[win16.RelocationAddressType( address_type ).name] += count
+        yield segment
+
+
+def optloader_merge_stats( reports ):
+    result = optloader_new_stats()
+    for report in reports:
+        result['elapsed'] += report['elapsed']
+        for key, value in report['timings'].items():
+            result['timings'][key] += value
+        for key, value in report['counters'].items():
+            result['counters'][key] += value if not isinstance( value, dict ) else collections.Counter( value )
+    return result
+
+
+# round off timings and work out rates
+def optloader_finish_stats( report ):
+    counters = report['counters']
+    timings = report['timings']
+    report['elapsed'] = round( report['elapsed'], 6 )
+    report['timings'] = {k: round( v, 6 ) for k, v in timings.items()}
+    report['counters'] = {k: dict( v ) if isinstance( v, dict ) else v for k, v in counters.items()}
+    report['rates'] = {
+        'unpack_mb_per_s': round( counters['bytes_out']/timings['unpack']/1e6, 3 ) if timings['unpack'] else None,
+        'avg_backref_length': round( counters['backref_bytes']/counters['backrefs'], 3 ) if counters['backrefs'] else None,
+        'bits_per_byte_out': round( counters['bits']/counters['bytes_out'], 3 ) if counters['bytes_out'] else None,
+        'ratio': round( counters['bytes_in']/counters['bytes_out'], 3 ) if counters['bytes_out'] else None,
+    }
+    return report
+
+
+# unpack one file, skipping targets newer than the source unless force is set.
+# returns a summary dict, with a stats report if stats is set
+def optloader_unpack_file( source, target, force=False, cache=None, native=True, jobs=1, stats=False ):
+    summary = {'source': source, 'target': target}
+    if not force and os.path.exists( target ) and os.path.getmtime( target ) >= os.path.getmtime( source ):
+        summary['status'] = 'skipped'
+        return summary
+
+    start = time.perf_counter()
+    with optloader_map_file( source ) as in_file:
+        if not optloader_detect( in_file ):
+            summary['status'] = 'not_optloader'
+            return summary
+        # a partial target would look up to date on the next run
+        temp_path = '{}.{}.tmp'.format( target, os.getpid() )
+        report = optloader_new_stats() if stats else None
+        try:
+            with OptloaderImage( in_file, cache=cache, native=native ) as image:
+                segments = image.segments( jobs=jobs, stats=report['counters'] if report else None )
+                if report:
+                    report['timings']['open'] = time.perf_counter()-start
+                    segments = optloader_count_segments( segments, report )
+                write_start = time.perf_counter()
+                with open( temp_path, 'wb' ) as f:
+                    relocations = optloader_write( in_file, image.header, segments, f )
+                if report:
+                    report['timings']['write'] = time.perf_counter()-write_start-report['timings']['unpack']
+            os.replace( temp_path, target )
+        except Exception as e:
+            summary['status'] = 'error'
+            summary['error'] = '{}: {}'.format( type( e ).__name__, e )
+            with contextlib.suppress( FileNotFoundError ):
+                os.remove( temp_path )
+            return summary
+
+    summary['status'] = 'unpacked'
+    summary['time'] = round( time.perf_counter()-start, 3 )
+    summary['segments'] = len( image )
+    summary['relocations'] = relocations
+    if report:
+        report['elapsed'] = time.perf_counter()-start
+        report['counters']['files'] = 1
+        report['counters']['segments'] = len( image )
+        summary['stats'] = optloader_finish_stats( report )
+    return summary
+
+
+# unpack many files into target_dir, one per worker, returns their summaries in order
+def optloader_batch( sources, target_dir, jobs=1, force=False, cache=None, native=True, stats=False ):
+    # mirror the layout of the sources under target_dir, so files with the
+    # same name in different directories don't end up on top of each other
+    base = os.path.commonpath( [os.path.dirname( os.path.abspath( s ) ) for s in sources] ) if sources else ''
+    targets = [os.path.join( target_dir, os.path.relpath( os.path.abspath( s ), base ) ) for s in sources]
+    for target in set( os.path.dirname( t ) for t in targets ) | {target_dir}:
+        os.makedirs( target, exist_ok=True )
+    forces = [force]*len( sources )
+    caches = [cache]*len( sources )
+    natives = [native]*len( sources )
+    job_counts = [1]*len( sources )
+    stats = [stats]*len( sources )
+    if jobs <= 1 or len( sources ) <= 1:
+        return list( map( optloader_unpack_file, sources, targets, forces, caches, natives, job_counts, stats ) )
+    with ProcessPoolExecutor( max_workers=jobs ) as pool:
+        return list( pool.map( optloader_unpack_file, sources, targets, forces, caches, natives, job_counts, stats ) )
+
+
+# expand a directory or glob pattern into a sorted list of files
+def optloader_batch_sources( source ):
+    if os.path.isdir( source ):
+        paths = [os.path.join( source, x ) for x in os.listdir( source )]
+    else:
+        paths = glob.glob( source )
+    return sorted( x for x in paths if os.path.isfile( x ) )
+
+
 DESCRIPTION = 'Unpack an obfuscated Win16 executable packed by OPTLOADER.'
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser( description=DESCRIPTION )
-    parser.add_argument( 'source', type=argparse.FileType( mode='rb' ), help='Source EXE file.' )
-    parser.add_argument( 'target', type=argparse.FileType( mode='wb' ), help='Target EXE file.' )
+    parser.add_argument( 'source', help='Source EXE file. In batch mode, a directory or glob pattern (e.g. "builds/*.EXE").' )
+    parser.add_argument( 'target', help='Target EXE file. In batch mode, the output directory.' )
+    parser.add_argument( '--jobs', type=int, default=1, help='Number of worker processes to use for segment decompression, or for files in batch mode (default: 1)', required=False )
+    parser.add_argument( '--batch', default=False, action='store_true', help='Unpack every OPTLOADER executable matching source into the target directory', required=False )
+    parser.add_argument( '--force', default=False, action='store_true', help='In batch mode, unpack files even if the target is up to date', required=False )
+    parser.add_argument( '--summary', type=argparse.FileType( mode='w' ), help='In batch mode, output JSON file for the per-file summary (default: stdout)', required=False )
+    parser.add_argument( '--cache', help='Directory for caching unpacked segments between runs', required=False )
+    parser.add_argument( '--cache-size', type=int, default=256, help='Maximum size of the segment cache in MB (default: 256)', required=False )
+    parser.add_argument( '--no-native', default=False, action='store_true', help="Don't use the Numba decompression kernel, even if Numba is installed", required=False )
+    parser.add_argument( '--stats', metavar='STATS_FILE', help='Write timings and counters for the run to this JSON file ("-" for stderr)', required=False )
     args = parser.parse_args()
 
-    result = optloader_unpack( args.source.read() )
-    args.target.write( result.export_data() )
-
+    cache = OptloaderCache( args.cache, max_size=args.cache_size*1024*1024 ) if args.cache else None
+
+    if args.batch:
+        start = time.perf_counter()
+        summary = optloader_batch( optloader_batch_sources( args.source ), args.target, jobs=args.jobs, force=args.force, cache=cache, native=not args.no_native, stats=bool( args.stats ) )
+        if args.stats:
+            # per-file timings are summed, so use the wall clock time for the total
+            stats = optloader_merge_stats( x['stats'] for x in summary if 'stats' in x )
+            stats['elapsed'] = time.perf_counter()-start
+            stats = optloader_finish_stats( stats )
+        if args.summary:
+            json.dump( summary, args.summary, indent=4 )
+        else:
+            print( json.dumps( summary, indent=4 ) )
+    else:
+        summary = optloader_unpack_file( args.source, args.target, force=True, cache=cache, native=not args.no_native, jobs=args.jobs, stats=bool( args.stats ) )
+        if summary['status'] == 'not_optloader':
+            sys.exit( 'Input file is not an OPTLOADER compressed executable' )
+        elif summary['status'] == 'error':
+            sys.exit( summary['error'] )
+        stats = summary.get( 'stats' )
+
+    if args.stats:
+        with (open( args.stats, 'w' ) if args.stats != '-' else contextlib.nullcontext( sys.stderr )) as f:
+            json.dump( stats, f, indent=4 )
+            f.write( '\n' )
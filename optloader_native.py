@@ -0,0 +1,143 @@
+# Numba kernel for optloader.py. importing Numba takes far longer than the
+# rest of optloader.py, so this module is only loaded the first time a
+# segment is decompressed with native=True.
+import numba
+import numpy
+
+
+# error code returned by the native kernel
+NATIVE_RANGE_ERROR = -1
+# slots in the counters array filled in by the native kernel, in the order
+# optloader_add_stream_stats takes them
+NATIVE_SHIFT, NATIVE_LITERALS, NATIVE_BACKREFS, NATIVE_BACKREF_BYTES, NATIVE_ESCAPES = range( 5 )
+
+# read count bits from the stream, fetching the next word as soon as the
+# last bit of the current one is consumed. returns (value, pos, word, shift);
+# pos is NATIVE_RANGE_ERROR if the stream runs past the end of src.
+@numba.njit( cache=True, inline='always' )
+def optloader_native_bits( src, pos, word, shift, count ):
+    value = 0
+    for i in range( count ):
+        shift -= 1
+        value = (value << 1) | ((word >> shift) & 1)
+        if shift == 0:
+            if pos+1 >= len( src ):
+                return value, NATIVE_RANGE_ERROR, word, shift
+            word = src[pos] | (src[pos+1] << 8)
+            pos += 2
+            shift = 16
+    return value, pos, word, shift
+
+# native version of OptloaderDecoder.decode. src and dest are uint8 arrays,
+# and may share memory. the stream is walked one bit at a time the same way
+# LoadAppSeg does, and back-references are copied a byte at a time, so
+# overlapping copies repeat the run just like the original. returns the
+# offset in src directly after the end-of-stream marker, or NATIVE_RANGE_ERROR,
+# and adds up what was in the stream in counters.
+@numba.njit( cache=True )
+def optloader_decode_native( src, pos, dest, di, counters ):
+    src_size = len( src )
+    dest_size = len( dest )
+    if pos+1 >= src_size:
+        return NATIVE_RANGE_ERROR
+    word = src[pos] | (src[pos+1] << 8)
+    pos += 2
+    shift = 16
+
+    while True:
+        literal, pos, word, shift = optloader_native_bits( src, pos, word, shift, 1 )
+        if pos < 0:
+            return pos
+        if literal:
+            if di >= dest_size or pos >= src_size:
+                return NATIVE_RANGE_ERROR
+            dest[di] = src[pos]
+            pos += 1
+            di += 1
+            counters[NATIVE_LITERALS] += 1
+            continue
+
+        # length: 0x, 10x, 110x, 1110xx, 11110xxx, or 11111 for
+        # a raw length byte
+        ones = 0
+        while ones < 5:
+            bit, pos, word, shift = optloader_native_bits( src, pos, word, shift, 1 )
+            if pos < 0:
+                return pos
+            if not bit:
+                break
+            ones += 1
+        if ones == 5:
+            if pos >= src_size:
+                return NATIVE_RANGE_ERROR
+            length = numba.int64( src[pos] )
+            pos += 1
+            counters[NATIVE_ESCAPES] += 1
+            if length > 0x81:
+                counters[NATIVE_SHIFT] = shift
+                return pos
+            elif length == 0x81:
+                continue
+        else:
+            extra, pos, word, shift = optloader_native_bits( src, pos, word, shift, (1, 1, 1, 2, 3)[ones] )
+            if pos < 0:
+                return pos
+            length = (2, 4, 6, 8, 12)[ones] + extra
+
+        if ones == 0 and length == 2:
+            # 2 byte back-references only get a single byte of offset,
+            # unless the length was escaped
+            distance = 1
+        else:
+            # high byte of the offset: 00, 010, 011x, 100xx, 101xxx,
+            # 110xxxx, 1110xxxx, 11110xxxx or 11111xxxxxx
+            code, pos, word, shift = optloader_native_bits( src, pos, word, shift, 2 )
+            if pos < 0:
+                return pos
+            if code == 0:
+                high, extra_bits = 0, 0
+            else:
+                bit, pos, word, shift = optloader_native_bits( src, pos, word, shift, 1 )
+                if pos < 0:
+                    return pos
+                if code == 1:
+                    high, extra_bits = (1, 0) if not bit else (2, 1)
+                elif code == 2:
+                    high, extra_bits = (4, 2) if not bit else (8, 3)
+                elif not bit:
+                    high, extra_bits = 16, 4
+                else:
+                    high, extra_bits = 32, 4
+                    for i in range( 2 ):
+                        bit, pos, word, shift = optloader_native_bits( src, pos, word, shift, 1 )
+                        if pos < 0:
+                            return pos
+                        if not bit:
+                            break
+                        high, extra_bits = (48, 4) if i == 0 else (64, 6)
+            extra, pos, word, shift = optloader_native_bits( src, pos, word, shift, extra_bits )
+            if pos < 0:
+                return pos
+            distance = ((high+extra) << 8) + 1
+
+        # the offset wraps around at the 64KB segment boundary
+        if pos >= src_size:
+            return NATIVE_RANGE_ERROR
+        si = (di - distance - src[pos]) & 0xffff
+        pos += 1
+        if di+length > dest_size or si+length > dest_size:
+            return NATIVE_RANGE_ERROR
+        for i in range( length ):
+            dest[di+i] = dest[si+i]
+        di += length
+        counters[NATIVE_BACKREFS] += 1
+        counters[NATIVE_BACKREF_BYTES] += length
+
+
+# if counts is a list, it's filled in with the counters for the stream
+def optloader_reverse_native( src, read_offset, dest, write_offset, counts=None ):
+    counters = numpy.zeros( 5, dtype=numpy.int64 )
+    end_offset = optloader_decode_native( numpy.frombuffer( src, dtype=numpy.uint8 ), read_offset, numpy.frombuffer( dest, dtype=numpy.uint8 ), write_offset, counters )
+    if counts is not None:
+        counts[:] = counters.tolist()
+    return end_offset
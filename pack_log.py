@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import itertools
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from convert_log import CHUNK_SIZE, TRACE_ALIGN, TRACE_COUNT, TRACE_DELTA, TRACE_ESCAPE, TRACE_HEADER, TRACE_INDEX_ENTRY, TRACE_MAGIC, TRACE_RAW, TRACE_RLE, TRACE_VERSION
+from convert_log import open_coverage_log, parse_chunk_numpy, read_chunks, split_chunk
+
+
+# records per block; blocks are the unit for decoding and for splitting
+# the trace between worker processes
+TRACE_BLOCK_RECORDS = 1 << 16
+
+TRACE_ENCODINGS = {
+    'raw': TRACE_RAW,
+    'rle': TRACE_RLE,
+    'delta': TRACE_DELTA,
+}
+
+
+def le_bytes( values, typecode ):
+    result = array.array( typecode, values )
+    if sys.byteorder == 'big' and result.itemsize > 1:
+        result.byteswap()
+    return result.tobytes()
+
+
+def parse_line( line ):
+    seg, sep, offset = line.partition( b':' )
+    try:
+        if not sep:
+            raise ValueError
+        seg, offset = int( seg, 16 ), int( offset, 16 )
+    except ValueError:
+        raise ValueError( 'Malformed coverage log line: {}'.format( line ) )
+    if not (0 <= seg <= 0xffff and 0 <= offset <= 0xffffffff):
+        raise ValueError( 'Coverage log line out of range: {}'.format( line ) )
+    return seg, offset
+
+
+# encode one block with NumPy as (encoding, wide, payload); with no encoding
+# given, whichever comes out smallest is used
+def encode_block( selectors, offsets, encoding=None ):
+    count = len( selectors )
+    wide = bool( count and offsets.max() > 0xffff )
+    offset_type = numpy.dtype( '<u4' if wide else '<u2' )
+    selectors = selectors.astype( '<u2' )
+    offsets = offsets.astype( offset_type )
+
+    # runs of identical records, for TRACE_RLE
+    record_starts = numpy.flatnonzero( numpy.append( True, (selectors[1:] != selectors[:-1]) | (offsets[1:] != offsets[:-1]) ) )
+    # runs of the same selector and offsets that don't fit in a byte, for TRACE_DELTA
+    selector_starts = numpy.flatnonzero( numpy.append( True, selectors[1:] != selectors[:-1] ) )
+    deltas = numpy.diff( offsets.astype( numpy.int64 ), prepend=0 )
+    escaped = (deltas <= TRACE_ESCAPE) | (deltas > 127)
+    escaped[:1] = True
+
+    sizes = {
+        TRACE_RAW: count*(2+offset_type.itemsize),
+        TRACE_RLE: TRACE_COUNT.size + len( record_starts )*(2+offset_type.itemsize+4),
+        TRACE_DELTA: 2*TRACE_COUNT.size + len( selector_starts )*6 + count + int( escaped.sum() )*offset_type.itemsize,
+    }
+    if encoding is None:
+        encoding = min( sizes, key=sizes.get )
+
+    def lengths( starts ):
+        return numpy.diff( numpy.append( starts, count ) ).astype( '<u4' )
+
+    if encoding == TRACE_RAW:
+        parts = [selectors, offsets]
+    elif encoding == TRACE_RLE:
+        parts = [numpy.array( [len( record_starts )], dtype='<u4' ), selectors[record_starts], offsets[record_starts], lengths( record_starts )]
+    else:
+        deltas = numpy.where( escaped, TRACE_ESCAPE, deltas ).astype( 'i1' )
+        counts = numpy.array( [len( selector_starts ), escaped.sum()], dtype='<u4' )
+        parts = [counts, selectors[selector_starts], lengths( selector_starts ), deltas, offsets[escaped]]
+    return encoding, wide, b''.join( x.tobytes() for x in parts )
+
+
+# encode one block as TRACE_RAW without NumPy, as (encoding, wide, payload)
+def encode_block_raw( selectors, offsets ):
+    wide = bool( offsets and max( offsets ) > 0xffff )
+    return TRACE_RAW, wide, le_bytes( selectors, 'H' ) + le_bytes( offsets, 'I' if wide else 'H' )
+
+
+# writes a binary coverage trace, as read by convert_log.TraceReader. fout must
+# be seekable, the header is filled in by close(). without NumPy every block
+# is TRACE_RAW
+class TraceWriter:
+    def __init__( self, fout, block_records=TRACE_BLOCK_RECORDS, encoding=None, use_numpy=True ):
+        self.fout = fout
+        self.block_records = block_records
+        self.encoding = encoding
+        self.use_numpy = bool( numpy and use_numpy )
+        self.start = fout.tell()
+        self.position = self.start+TRACE_HEADER.size
+        self.count = 0
+        self.index = []
+        self.selectors = []
+        self.offsets = []
+        self.pending = 0
+        fout.write( bytes( TRACE_HEADER.size ) )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, *exc ):
+        if exc_type is None:
+            self.close()
+
+    # add records, as NumPy arrays or lists of selectors and offsets
+    def write( self, selectors, offsets ):
+        self.selectors.append( selectors )
+        self.offsets.append( offsets )
+        self.pending += len( selectors )
+        if self.pending >= self.block_records:
+            self.flush( final=False )
+
+    # write out full blocks of pending records, and the rest if final is set
+    def flush( self, final=True ):
+        if self.use_numpy:
+            selectors = numpy.concatenate( self.selectors ) if self.selectors else numpy.empty( 0, dtype=numpy.uint32 )
+            offsets = numpy.concatenate( self.offsets ) if self.offsets else numpy.empty( 0, dtype=numpy.uint32 )
+        else:
+            selectors = list( itertools.chain.from_iterable( self.selectors ) )
+            offsets = list( itertools.chain.from_iterable( self.offsets ) )
+        start = 0
+        while len( selectors )-start >= self.block_records or (final and start < len( selectors )):
+            end = start+self.block_records
+            self.write_block( selectors[start:end], offsets[start:end] )
+            start = end
+        self.selectors = [selectors[start:]]
+        self.offsets = [offsets[start:]]
+        self.pending = len( selectors )-start
+
+    def write_block( self, selectors, offsets ):
+        if self.use_numpy:
+            encoding, wide, payload = encode_block( selectors, offsets, self.encoding )
+        else:
+            encoding, wide, payload = encode_block_raw( selectors, offsets )
+        self.index.append( (self.position, len( selectors ), len( payload ), encoding, wide) )
+        fill = -len( payload ) % TRACE_ALIGN
+        self.fout.write( payload + bytes( fill ) )
+        self.position += len( payload )+fill
+        self.count += len( selectors )
+
+    # write the remaining records, the block index and the header
+    def close( self ):
+        self.flush()
+        index_offset = self.position
+        self.fout.write( TRACE_COUNT.pack( len( self.index ) ) )
+        for entry in self.index:
+            self.fout.write( TRACE_INDEX_ENTRY.pack( *entry ) )
+        end = self.fout.tell()
+        self.fout.seek( self.start )
+        self.fout.write( TRACE_HEADER.pack( TRACE_MAGIC, TRACE_VERSION, 0, self.count, index_offset ) )
+        self.fout.seek( end )
+
+
+# convert a DOSBox coverage log to a binary trace, returns the number of records.
+# lines must be hex seg:offset with a 16-bit selector and a 32-bit offset
+def pack_log( fin, fout, block_records=TRACE_BLOCK_RECORDS, encoding=None, use_numpy=True, chunk_size=CHUNK_SIZE ):
+    use_numpy = bool( numpy and use_numpy )
+    with TraceWriter( fout, block_records=block_records, encoding=encoding, use_numpy=use_numpy ) as writer:
+        for chunk, terminated in read_chunks( open_coverage_log( fin ), chunk_size=chunk_size ):
+            parsed = parse_chunk_numpy( chunk ) if use_numpy and terminated else None
+            if parsed is not None:
+                rows, selectors, offsets = parsed
+            else:
+                records = [parse_line( x ) for x in split_chunk( chunk, terminated )]
+                selectors = [x[0] for x in records]
+                offsets = [x[1] for x in records]
+                if use_numpy:
+                    selectors = numpy.array( selectors, dtype=numpy.uint32 )
+                    offsets = numpy.array( offsets, dtype=numpy.uint32 )
+            writer.write( selectors, offsets )
+    return writer.count
+
+
+DESCRIPTION = 'Pack a DOSBox coverage log into a compact binary trace for convert_log.py.'
+EPILOG = """Each instruction in the log is stored as a 16-bit selector and a 16-bit offset (32-bit for blocks that need it), and blocks of records are run-length or delta encoded, whichever is smaller. convert_log.py detects these traces and reads them through mmap, so converting a log several times with different segment maps or options skips reading and parsing the text each time.
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description=DESCRIPTION, epilog=EPILOG )
+    parser.add_argument( 'coverage_log', type=argparse.FileType( mode='rb' ), help='Coverage log taken from DOSBox: LOGC [num of instructions]. Can be gzip or zstd compressed, or "-" for stdin' )
+    parser.add_argument( 'out_file', help='Output binary trace file' )
+    parser.add_argument( '--encoding', choices=['auto']+list( TRACE_ENCODINGS ), default='auto', help='Encoding for blocks of records (default: auto, the smallest for each block)', required=False )
+    parser.add_argument( '--block-records', type=int, default=TRACE_BLOCK_RECORDS, help='Number of records in each block (default: {})'.format( TRACE_BLOCK_RECORDS ), required=False )
+    parser.add_argument( '--no-numpy', default=False, action='store_true', help="Always use the pure Python packer, even if NumPy is installed; blocks are then always raw", required=False )
+    args = parser.parse_args()
+
+    if args.block_records < 1:
+        parser.error( '--block-records must be at least 1' )
+    if args.encoding not in ('auto', 'raw') and (args.no_numpy or not numpy):
+        parser.error( '--encoding {} needs NumPy'.format( args.encoding ) )
+
+    temp_path = '{}.{}.tmp'.format( args.out_file, os.getpid() )
+    try:
+        with open( temp_path, 'wb' ) as fout:
+            pack_log( args.coverage_log, fout, block_records=args.block_records, encoding=TRACE_ENCODINGS.get( args.encoding ), use_numpy=not args.no_numpy )
+        os.replace( temp_path, args.out_file )
+    except ValueError as e:
+        os.remove( temp_path )
+        sys.exit( str( e ) )